@@ -0,0 +1,148 @@
+"""
+Ограничение нагрузки на прием событий (admission control)
+
+Клиент в цикле повторов может слать POST /event без остановки, а каждое
+событие - это несколько записей в SQLite и (для SMS) отправка в Telegram.
+Чтобы одно устройство не замедляло остальные, перед записью проверяются:
+  - общий предел одновременно обрабатываемых запросов ADMISSION_MAX_IN_FLIGHT;
+  - token bucket устройства: в среднем ADMISSION_DEVICE_RATE событий в секунду,
+    кратковременно - до ADMISSION_DEVICE_BURST подряд. Токен списывается за
+    каждое событие, в том числе за каждое событие пакета POST /events.
+Запрос сверх лимита получает 429 с Retry-After. Устройства из
+ADMISSION_ALLOWLIST (ID через запятую) не ограничиваются. 0 в настройке
+отключает соответствующий лимит; по умолчанию лимит устройства отключен, а общий
+предел выше обычной нагрузки - устройство, досылающее накопленные события
+после восстановления связи, не должно получать 429.
+
+Состояние меняется только из цикла событий FastAPI, поэтому блокировки не нужны.
+"""
+import math
+import os
+import time
+from typing import Dict, Optional, Set
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst"""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """Взять токен. Возвращает 0, если токен есть, иначе через сколько секунд он появится"""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+    def is_full(self, rate: float, burst: float, now: float) -> bool:
+        return self.tokens + (now - self.updated) * rate >= burst
+
+
+class Rejected(Exception):
+    """Запрос отклонен ограничением нагрузки"""
+
+    def __init__(self, reason: str, retry_after: float):
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(reason)
+
+    @property
+    def retry_after_header(self) -> str:
+        """Значение Retry-After (целые секунды, не меньше 1)"""
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class AdmissionControl:
+    """Лимит событий на устройство и общий предел одновременных запросов"""
+
+    # Ведер больше этого числа - удаляем полные (давно неактивные устройства)
+    MAX_BUCKETS = 10000
+
+    def __init__(self, device_rate: float = 0, device_burst: float = 0,
+                 max_in_flight: int = 0, allowlist: Optional[Set[str]] = None):
+        self.configure(device_rate, device_burst, max_in_flight, allowlist)
+
+    def configure(self, device_rate: float, device_burst: float,
+                  max_in_flight: int, allowlist: Optional[Set[str]] = None):
+        """Задать лимиты и сбросить состояние"""
+        self.device_rate = device_rate
+        self.device_burst = max(1.0, device_burst)
+        self.max_in_flight = max_in_flight
+        self.allowlist = allowlist or set()
+        self.in_flight = 0
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.rejected_in_flight = 0
+        self.rejected_by_device: Dict[str, int] = {}
+
+    def acquire(self, device_id: Optional[str] = None):
+        """
+        Занять место для запроса устройства device_id (None - запрос без устройства,
+        проверяется только общий предел). Бросает Rejected; после обработки - release().
+        Общий предел проверяется первым: запрос, отклоненный из-за перегрузки,
+        не расходует токены устройства
+        """
+        if device_id is not None and device_id in self.allowlist:
+            self.in_flight += 1
+            return
+        if self.max_in_flight > 0 and self.in_flight >= self.max_in_flight:
+            self.rejected_in_flight += 1
+            raise Rejected("Сервер перегружен, повторите запрос позже", 1.0)
+        self.charge(device_id)
+        self.in_flight += 1
+
+    def charge(self, device_id: Optional[str]):
+        """Списать токен устройства за одно событие (без общего предела). Бросает Rejected"""
+        if device_id is None or device_id in self.allowlist or self.device_rate <= 0:
+            return
+        retry_after = self._take(device_id)
+        if retry_after:
+            self.rejected_by_device[device_id] = self.rejected_by_device.get(device_id, 0) + 1
+            raise Rejected(f"Превышен лимит событий устройства {device_id}", retry_after)
+
+    def release(self):
+        self.in_flight -= 1
+
+    def _take(self, device_id: str) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(device_id)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                self._drop_full_buckets(now)
+            bucket = self._buckets[device_id] = TokenBucket(self.device_burst, now)
+        return bucket.take(self.device_rate, self.device_burst, now)
+
+    def _drop_full_buckets(self, now: float):
+        for device_id in [device_id for device_id, bucket in self._buckets.items()
+                          if bucket.is_full(self.device_rate, self.device_burst, now)]:
+            del self._buckets[device_id]
+
+    def snapshot(self) -> Dict:
+        """Состояние для /metrics"""
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "device_rate": self.device_rate,
+            "device_burst": self.device_burst,
+            "rejected_in_flight": self.rejected_in_flight,
+            "rejected_by_device": dict(sorted(self.rejected_by_device.items()))
+        }
+
+
+admission = AdmissionControl()
+
+
+def init_admission() -> AdmissionControl:
+    """Настроить лимиты из переменных окружения (вызывается при старте приложения)"""
+    admission.configure(
+        device_rate=float(os.getenv('ADMISSION_DEVICE_RATE', '0')),
+        device_burst=float(os.getenv('ADMISSION_DEVICE_BURST', '0')),
+        max_in_flight=int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '1024')),
+        allowlist={item.strip() for item in os.getenv('ADMISSION_ALLOWLIST', '').split(',') if item.strip()}
+    )
+    return admission
@@ -1,31 +1,273 @@
 """
 Модуль для работы с базой данных SQLite
 Содержит функции для создания таблиц и работы с данными
+
+Данные могут быть распределены по нескольким файлам (app/storage.py):
+устройства и привязки - в каталоге, события и SMS - в шарде устройства
 """
 import sqlite3
 import json
 import os
+import asyncio
+import functools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
+
+from app.event_codec import encode_event, decode_event
+from app.device_registry import registry, bindings
+from app.storage import StorageLayout
+
+logger = logging.getLogger(__name__)
 
 
 DATABASE_NAME = os.getenv('DATABASE_PATH', 'devices.db')
 
+# Каталог (DATABASE_NAME) и файлы-шарды с журналами событий и SMS
+layout = StorageLayout(DATABASE_NAME, int(os.getenv('DATABASE_SHARDS', '1')))
+
+
+def _pragma_settings() -> Dict[str, str]:
+    """
+    Настройки SQLite для каждого соединения пула.
+    Читаются при создании пула, чтобы учитывались значения из config.env
+    """
+    return {
+        # Действует только для нового файла (до первой таблицы), поэтому идет перед journal_mode.
+        # Существующий файл переводится в этот режим полным VACUUM: scripts/compact_events.py --vacuum
+        'auto_vacuum': 'INCREMENTAL',
+        'journal_mode': 'WAL',
+        'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'cache_size': os.getenv('SQLITE_CACHE_SIZE', '-16000'),    # отрицательное значение - в КБ
+        'mmap_size': os.getenv('SQLITE_MMAP_SIZE', '268435456'),   # 256 МБ
+        'busy_timeout': os.getenv('SQLITE_BUSY_TIMEOUT', '5000'),  # мс
+        'temp_store': 'MEMORY',
+    }
+
+
+class HookedConnection(sqlite3.Connection):
+    """
+    Соединение с действиями после фиксации транзакции.
+    Через on_commit обновляются структуры в памяти (реестр устройств),
+    только когда запись действительно сохранена
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commit_hooks = []
 
-def get_connection():
-    """Создать соединение с базой данных"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    def on_commit(self, callback):
+        """Выполнить callback после фиксации текущей транзакции"""
+        self.commit_hooks.append(callback)
+
+    def run_commit_hooks(self):
+        hooks, self.commit_hooks = self.commit_hooks, []
+        for callback in hooks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Ошибка обработчика после фиксации транзакции")
+
+    def commit(self):
+        super().commit()
+        self.run_commit_hooks()
+
+    def rollback(self):
+        super().rollback()
+        self.commit_hooks.clear()
+
+
+def _open_connection(database: str, pragmas: Dict[str, str]) -> sqlite3.Connection:
+    """Открыть соединение и применить PRAGMA"""
+    busy_timeout_ms = int(pragmas.get('busy_timeout', 5000))
+    conn = sqlite3.connect(
+        database,
+        timeout=busy_timeout_ms / 1000,
+        check_same_thread=False,  # соединения пула используются из разных потоков
+        factory=HookedConnection
+    )
     conn.row_factory = sqlite3.Row  # Позволяет обращаться к колонкам по имени
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
     return conn
 
 
-def init_database():
-    """Инициализация базы данных и создание таблиц"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Таблица устройств
-    cursor.execute("""
+class ConnectionPool:
+    """
+    Пул переиспользуемых соединений SQLite.
+    Соединения открываются лениво (не больше size) и возвращаются в пул после использования
+    """
+
+    def __init__(self, database: str, size: int, pragmas: Dict[str, str]):
+        self.database = database
+        self.size = size
+        self.pragmas = pragmas
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self, timeout: Optional[float] = None) -> sqlite3.Connection:
+        """Взять соединение из пула (или открыть новое, если лимит не исчерпан)"""
+        if self._closed:
+            raise RuntimeError("Пул соединений закрыт")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return _open_connection(self.database, self.pragmas)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("Нет свободных соединений с базой данных")
+
+    def release(self, conn: sqlite3.Connection):
+        """Вернуть соединение в пул"""
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    def close(self):
+        """Закрыть все свободные соединения пула"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+# Пулы соединений по файлам базы (каталог и шарды)
+_pools: Dict[str, ConnectionPool] = {}
+_pool_lock = threading.Lock()
+
+
+def init_pool() -> ConnectionPool:
+    """
+    Создать пулы соединений для всех файлов базы (вызывается один раз при старте приложения).
+    Возвращает пул каталога
+    """
+    with _pool_lock:
+        if not _pools:
+            size = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+            pragmas = _pragma_settings()
+            for database in layout.files:
+                _pools[database] = ConnectionPool(database, size=size, pragmas=pragmas)
+        return _pools[layout.catalog]
+
+
+def close_pool():
+    """Закрыть пулы соединений (вызывается при остановке приложения)"""
+    global _executor
+    with _pool_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+    registry.clear()
+    bindings.clear()
+
+
+@contextmanager
+def connection(database: Optional[str] = None):
+    """
+    Взять соединение из пула файла database (по умолчанию - каталог).
+    При успешном выходе транзакция фиксируется, при исключении - откатывается
+    """
+    if not _pools:
+        init_pool()
+    pool = _pools[database or layout.catalog]
+    conn = pool.acquire(timeout=int(pool.pragmas.get('busy_timeout', 5000)) / 1000)
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+
+def get_connection(database: Optional[str] = None):
+    """
+    Создать отдельное соединение с базой данных (вне пула), по умолчанию - с каталогом.
+    Для внутренних функций модуля используйте connection()
+    """
+    return _open_connection(database or layout.catalog, _pragma_settings())
+
+
+# Устройство считается онлайн, если последнее событие было не позднее 20 минут назад
+ONLINE_THRESHOLD_SECONDS = 20 * 60
+
+# Форматы времени, которые присылают устройства
+TIMESTAMP_FORMATS = ("%d.%m.%Y %H:%M:%S",)
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[int]:
+    """
+    Преобразовать время из события в Unix-время (секунды).
+    Поддерживаются "14.10.2025 12:00:00" и ISO "2025-10-14T12:00:00".
+    Время без часового пояса считается локальным временем сервера
+    """
+    if not value:
+        return None
+    parsed = None
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            parsed = datetime.strptime(value, fmt)
+            break
+        except ValueError:
+            pass
+    if parsed is None:
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return int(parsed.timestamp())
+
+
+# ===== Миграции схемы =====
+# Каждая миграция - (версия, описание, шаги). Шаг - SQL-строка или функция(conn).
+# Миграции применяются строго по возрастанию версии, каждая в своей транзакции.
+# Новые изменения схемы добавляются ТОЛЬКО в конец списка, уже выпущенные миграции не меняются.
+
+
+MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        # Таблица устройств
+        """
         CREATE TABLE IF NOT EXISTS devices (
             id TEXT PRIMARY KEY,
             name TEXT,
@@ -36,10 +278,9 @@ def init_database():
             last_seen TEXT,
             online BOOLEAN DEFAULT 0
         )
-    """)
-    
-    # Таблица событий
-    cursor.execute("""
+        """,
+        # Таблица событий
+        """
         CREATE TABLE IF NOT EXISTS events (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             device_id TEXT NOT NULL,
@@ -48,10 +289,9 @@ def init_database():
             data TEXT NOT NULL,
             FOREIGN KEY (device_id) REFERENCES devices (id)
         )
-    """)
-    
-    # Таблица SMS
-    cursor.execute("""
+        """,
+        # Таблица SMS
+        """
         CREATE TABLE IF NOT EXISTS sms_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             device_id TEXT NOT NULL,
@@ -60,10 +300,9 @@ def init_database():
             message TEXT,
             FOREIGN KEY (device_id) REFERENCES devices (id)
         )
-    """)
-    
-    # Таблица привязок устройств к Telegram чатам
-    cursor.execute("""
+        """,
+        # Таблица привязок устройств к Telegram чатам
+        """
         CREATE TABLE IF NOT EXISTS device_chat_bindings (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             device_id TEXT NOT NULL,
@@ -72,284 +311,985 @@ def init_database():
             UNIQUE(device_id, chat_id),
             FOREIGN KEY (device_id) REFERENCES devices (id)
         )
+        """,
+    ]),
+    (2, "Индексы для частых запросов", [
+        # История SMS устройства (get_device_sms)
+        "CREATE INDEX IF NOT EXISTS idx_sms_logs_device_timestamp ON sms_logs (device_id, timestamp DESC)",
+        # События устройства и выборки по типу
+        "CREATE INDEX IF NOT EXISTS idx_events_device_timestamp ON events (device_id, timestamp DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_events_type ON events (type)",
+        # Поиск устройства по имени для SMS без device.id
+        "CREATE INDEX IF NOT EXISTS idx_devices_name ON devices (name)",
+        # Устройства чата (get_chat_bindings). Для get_device_chats уже есть
+        # автоматический индекс UNIQUE(device_id, chat_id)
+        "CREATE INDEX IF NOT EXISTS idx_bindings_chat ON device_chat_bindings (chat_id, device_id)",
+    ]),
+    (3, "Время событий в Unix-формате", [
+        # Исходные строки остаются для отображения, *_ts - для сортировки и фильтров
+        "ALTER TABLE devices ADD COLUMN last_seen_ts INTEGER",
+        "ALTER TABLE sms_logs ADD COLUMN timestamp_ts INTEGER",
+        "ALTER TABLE events ADD COLUMN timestamp_ts INTEGER",
+        lambda conn: _backfill_timestamps(conn),
+        # Индексы по текстовому времени DD.MM.YYYY не дают хронологического порядка
+        "DROP INDEX IF EXISTS idx_sms_logs_device_timestamp",
+        "DROP INDEX IF EXISTS idx_events_device_timestamp",
+        "CREATE INDEX IF NOT EXISTS idx_devices_last_seen_ts ON devices (last_seen_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_sms_logs_device_ts ON sms_logs (device_id, timestamp_ts DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_events_device_ts ON events (device_id, timestamp_ts)",
+    ]),
+    (4, "Индекс для постраничной выдачи SMS", [
+        # Курсор страниц SMS - id записи в пределах устройства
+        "CREATE INDEX IF NOT EXISTS idx_sms_logs_device_id ON sms_logs (device_id, id)",
+    ]),
+    (5, "Версии изменений для дельта-синхронизации", [
+        # Счетчик изменений таблицы; каждая измененная строка получает новое значение счетчика
+        """
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+        """,
+        "INSERT OR IGNORE INTO table_versions (name, version) VALUES ('devices', 0)",
+        "ALTER TABLE devices ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_devices_row_version ON devices (row_version)",
+    ]),
+    (6, "Хранение журнала событий по сроку и инкрементальный VACUUM", [
+        # Новые файлы создаются с auto_vacuum = INCREMENTAL (_pragma_settings). Полный VACUUM
+        # существующего файла блокирует его на минуты, поэтому при старте не выполняется
+        # Удаление устаревших событий по типу и времени
+        "CREATE INDEX IF NOT EXISTS idx_events_type_ts ON events (type, timestamp_ts)",
+        "DROP INDEX IF EXISTS idx_events_type",
+    ]),
+    (7, "Полнотекстовый поиск по SMS (FTS5)", [
+        # Индекс без копии данных (external content): тексты хранятся только в sms_logs
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS sms_fts USING fts5(
+            message,
+            sender,
+            content='sms_logs',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        # Триггеры поддерживают индекс при каждой записи в sms_logs
+        """
+        CREATE TRIGGER IF NOT EXISTS sms_logs_fts_insert AFTER INSERT ON sms_logs BEGIN
+            INSERT INTO sms_fts (rowid, message, sender) VALUES (new.id, new.message, new.sender);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS sms_logs_fts_delete AFTER DELETE ON sms_logs BEGIN
+            INSERT INTO sms_fts (sms_fts, rowid, message, sender) VALUES ('delete', old.id, old.message, old.sender);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS sms_logs_fts_update AFTER UPDATE ON sms_logs BEGIN
+            INSERT INTO sms_fts (sms_fts, rowid, message, sender) VALUES ('delete', old.id, old.message, old.sender);
+            INSERT INTO sms_fts (rowid, message, sender) VALUES (new.id, new.message, new.sender);
+        END
+        """,
+        # Индексируем уже сохраненные SMS
+        "INSERT INTO sms_fts (sms_fts) VALUES ('rebuild')",
+    ]),
+    (8, "Ключи идемпотентности событий", [
+        # Ключ повтора события (app/idempotency.py); у событий до миграции - NULL
+        "ALTER TABLE events ADD COLUMN dedup_key BLOB",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_events_dedup_key ON events (dedup_key) WHERE dedup_key IS NOT NULL",
+    ]),
+    (9, "Очередь уведомлений о SMS (outbox)", [
+        # Запись создается в одной транзакции с SMS и хранится в том же файле,
+        # доставляет ее фоновый обработчик (app/notification_outbox.py)
+        """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sms_id INTEGER NOT NULL,
+            device_id TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending, delivered, failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_ts REAL NOT NULL,
+            done_chats TEXT,                          -- JSON: чаты, которым больше не отправляем
+            last_error TEXT,
+            created_ts REAL NOT NULL,
+            updated_ts REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON notification_outbox (next_attempt_ts) WHERE status = 'pending'",
+    ]),
+]
+
+
+def _backfill_timestamps(conn: sqlite3.Connection):
+    """Заполнить *_ts для записей, созданных до миграции 3"""
+    for table, text_column, ts_column in (
+        ('devices', 'last_seen', 'last_seen_ts'),
+        ('sms_logs', 'timestamp', 'timestamp_ts'),
+        ('events', 'timestamp', 'timestamp_ts'),
+    ):
+        # Разных значений времени заметно меньше, чем строк
+        values = conn.execute(f"SELECT DISTINCT {text_column} FROM {table}").fetchall()
+        conn.executemany(
+            f"UPDATE {table} SET {ts_column} = ? WHERE {text_column} = ?",
+            [(parse_timestamp(row[0]), row[0]) for row in values if row[0]]
+        )
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы базы данных (0 - миграции не применялись)"""
+    row = conn.execute("SELECT MAX(version) AS version FROM schema_migrations").fetchone()
+    return row['version'] or 0
+
+
+def run_migrations(conn: sqlite3.Connection) -> List[int]:
+    """
+    Применить недостающие миграции.
+    Возвращает список примененных версий
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
     """)
-    
-    conn.commit()
-    conn.close()
+    if conn.in_transaction:
+        conn.commit()
 
+    applied = []
+    isolation_level = conn.isolation_level
+    # Транзакциями управляем вручную, чтобы DDL и запись версии были атомарны
+    conn.isolation_level = None
+    try:
+        for version, name, steps in MIGRATIONS:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Версию проверяем под блокировкой: миграции может запускать несколько процессов
+                if version <= get_schema_version(conn):
+                    conn.execute("ROLLBACK")
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                    (version, name, datetime.now().isoformat())
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+            logger.info("Применена миграция %s: %s", version, name)
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
 
-def save_event(device_id: str, event_type: str, timestamp: str, data: dict):
-    """Сохранить событие в таблицу events"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        INSERT INTO events (device_id, type, timestamp, data)
-        VALUES (?, ?, ?, ?)
-    """, (device_id, event_type, timestamp, json.dumps(data, ensure_ascii=False)))
-    
-    conn.commit()
-    conn.close()
 
+def init_database():
+    """Инициализация базы данных: создание таблиц и применение миграций во всех файлах"""
+    for database in layout.files:
+        with connection(database) as conn:
+            run_migrations(conn)
 
-def update_device(device_id: str, data: dict):
-    """Обновить или создать запись устройства"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Проверяем, существует ли устройство
-    cursor.execute("SELECT id FROM devices WHERE id = ?", (device_id,))
-    exists = cursor.fetchone()
+
+# ===== Запись данных =====
+# Функции с суффиксом _tx выполняют запись на переданном соединении и не фиксируют транзакцию.
+# Их использует единый писатель (app/ingest_writer.py), объединяющий запросы в пакеты.
+# Файл базы для операции определяет database_for_operation: функции каталога помечены
+# @_catalog_tx, функции журналов устройства - @_device_shard_tx (первый аргумент - device_id).
+# Остальным функциям (обслуживание) файл передается явно.
+
+def _catalog_tx(func):
+    func.storage = 'catalog'
+    return func
+
+
+def _device_shard_tx(func):
+    func.storage = 'device_shard'
+    return func
+
+
+def database_for_operation(func, args: tuple) -> str:
+    """Файл базы, в котором выполняется операция записи (функция_tx, args)"""
+    storage = getattr(func, 'storage', None)
+    if storage == 'catalog':
+        return layout.catalog
+    if storage == 'device_shard':
+        return layout.shard_for(args[0])
+    raise ValueError(f"Для операции {func.__name__} нужно явно указать файл базы")
+
+
+class DuplicateEvent(Exception):
+    """Событие с таким ключом идемпотентности уже сохранено"""
+
+    def __init__(self, device_id: str, event_type: str):
+        self.device_id = device_id
+        self.event_type = event_type
+        super().__init__(f"Событие {event_type} устройства {device_id} уже сохранено")
+
+
+@_device_shard_tx
+def save_event_tx(conn: sqlite3.Connection, device_id: str, event_type: str, timestamp: str,
+                  data: Union[dict, bytes], dedup_key: Optional[bytes] = None):
+    """
+    Сохранить событие в таблицу events (в текущей транзакции, в сжатом виде - app/event_codec.py).
+    Если событие с ключом dedup_key уже есть, бросает DuplicateEvent - run_write_batch
+    откатывает остальные операции запроса
+    """
+    cursor = conn.execute("""
+        INSERT INTO events (device_id, type, timestamp, timestamp_ts, data, dedup_key)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT DO NOTHING
+    """, (device_id, event_type, timestamp, parse_timestamp(timestamp), encode_event(data), dedup_key))
+    if cursor.rowcount == 0:
+        raise DuplicateEvent(device_id, event_type)
+
+
+# Поля устройства, которые можно обновлять из событий и через API
+DEVICE_FIELDS = ('name', 'battery', 'signal_strength', 'network_type', 'internet')
+
+
+@_catalog_tx
+def update_device_tx(conn: sqlite3.Connection, device_id: str, data: dict, default_name: Optional[str] = None):
+    """
+    Обновить или создать запись устройства одним запросом UPSERT (в текущей транзакции).
     
+    Обновляются только поля, переданные в data. Имя меняется, только если
+    'name' есть в data; default_name используется лишь при создании устройства,
+    поэтому имя, заданное пользователем, события не перезаписывают
+    """
     timestamp = data.get('timestamp', datetime.now().isoformat())
     
-    if exists:
-        # Обновляем существующее устройство
-        update_fields = []
-        values = []
-        
-        if 'name' in data:
-            update_fields.append("name = ?")
-            values.append(data['name'])
-        if 'battery' in data:
-            update_fields.append("battery = ?")
-            values.append(data['battery'])
-        if 'signal_strength' in data:
-            update_fields.append("signal_strength = ?")
-            values.append(data['signal_strength'])
-        if 'network_type' in data:
-            update_fields.append("network_type = ?")
-            values.append(data['network_type'])
-        if 'internet' in data:
-            update_fields.append("internet = ?")
-            values.append(data['internet'])
-        
-        update_fields.append("last_seen = ?")
-        values.append(timestamp)
-        
-        values.append(device_id)
-        
-        cursor.execute(f"""
-            UPDATE devices 
-            SET {', '.join(update_fields)}
-            WHERE id = ?
-        """, values)
+    if 'name' in data:
+        name = data['name']
     else:
-        # Создаем новое устройство
-        cursor.execute("""
-            INSERT INTO devices (id, name, battery, signal_strength, network_type, internet, last_seen, online)
-            VALUES (?, ?, ?, ?, ?, ?, ?, 1)
-        """, (
-            device_id,
-            data.get('name', f'Device {device_id}'),
-            data.get('battery', 0),
-            data.get('signal_strength', 0),
-            data.get('network_type', 'Unknown'),
-            data.get('internet', 'Unknown'),
-            timestamp
-        ))
+        name = default_name or f'Device {device_id}'
+    
+    update_fields = [f"{field} = excluded.{field}" for field in DEVICE_FIELDS if field in data]
+    update_fields.append("last_seen = excluded.last_seen")
+    update_fields.append("last_seen_ts = excluded.last_seen_ts")
+    update_fields.append("row_version = excluded.row_version")
+    
+    # Новая версия таблицы devices для клиентов, запрашивающих изменения (?since=)
+    row_version = conn.execute(
+        "UPDATE table_versions SET version = version + 1 WHERE name = 'devices' RETURNING version"
+    ).fetchone()[0]
     
-    conn.commit()
-    conn.close()
+    row = conn.execute(f"""
+        INSERT INTO devices (id, name, battery, signal_strength, network_type, internet, last_seen, last_seen_ts, row_version, online)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+        ON CONFLICT(id) DO UPDATE SET {', '.join(update_fields)}
+        RETURNING *
+    """, (
+        device_id,
+        name,
+        data.get('battery', 0),
+        data.get('signal_strength', 0),
+        data.get('network_type', 'Unknown'),
+        data.get('internet', 'Unknown'),
+        timestamp,
+        parse_timestamp(timestamp),
+        row_version
+    )).fetchone()
+    
+    # Реестр в памяти обновляется только после фиксации транзакции
+    conn.on_commit(lambda: registry.apply(row))
+
+
+@_device_shard_tx
+def save_sms_tx(conn: sqlite3.Connection, device_id: str, timestamp: str, sender: str, message: str,
+                notify: bool = False) -> int:
+    """
+    Сохранить SMS в таблицу sms_logs (в текущей транзакции). Возвращает id SMS.
+    notify - поставить уведомление в очередь notification_outbox в той же транзакции
+    """
+    sms_id = conn.execute("""
+        INSERT INTO sms_logs (device_id, timestamp, timestamp_ts, sender, message)
+        VALUES (?, ?, ?, ?, ?)
+    """, (device_id, timestamp, parse_timestamp(timestamp), sender, message)).lastrowid
+    if notify:
+        now = time.time()
+        conn.execute("""
+            INSERT INTO notification_outbox (sms_id, device_id, next_attempt_ts, created_ts, updated_ts)
+            VALUES (?, ?, ?, ?, ?)
+        """, (sms_id, device_id, now, now, now))
+    return sms_id
+
+
+def update_notification_tx(conn: sqlite3.Connection, outbox_id: int, status: str, attempts: int,
+                           next_attempt_ts: float, done_chats: List[int], last_error: Optional[str]):
+    """Записать результат попытки доставки уведомления (в текущей транзакции)"""
+    conn.execute("""
+        UPDATE notification_outbox
+        SET status = ?, attempts = ?, next_attempt_ts = ?, done_chats = ?, last_error = ?, updated_ts = ?
+        WHERE id = ?
+    """, (status, attempts, next_attempt_ts, json.dumps(done_chats), last_error, time.time(), outbox_id))
+
+
+def delete_delivered_notifications_tx(conn: sqlite3.Connection, cutoff_ts: float, limit: int) -> int:
+    """Удалить до limit доставленных уведомлений старше cutoff_ts. Возвращает число удаленных строк"""
+    cursor = conn.execute("""
+        DELETE FROM notification_outbox WHERE id IN (
+            SELECT id FROM notification_outbox
+            WHERE status = 'delivered' AND updated_ts < ?
+            LIMIT ?
+        )
+    """, (cutoff_ts, limit))
+    return cursor.rowcount
+
+
+def delete_expired_events_tx(conn: sqlite3.Connection, event_type: str, cutoff_ts: int, limit: int,
+                             untimed_max_id: Optional[int] = None) -> int:
+    """
+    Удалить до limit событий типа event_type старше cutoff_ts. Возвращает число удаленных строк.
+    События с неразобранным временем (timestamp_ts IS NULL) удаляются, если записаны
+    не позже устаревшего события того же типа: id <= untimed_max_id (get_expired_events_boundary)
+    """
+    cursor = conn.execute("""
+        DELETE FROM events WHERE id IN (
+            SELECT id FROM events
+            WHERE type = ? AND timestamp_ts < ?
+            UNION ALL
+            SELECT id FROM events
+            WHERE type = ? AND timestamp_ts IS NULL AND id <= ?
+            LIMIT ?
+        )
+    """, (event_type, cutoff_ts, event_type, untimed_max_id, limit))
+    return cursor.rowcount
+
+
+def compact_legacy_events_tx(conn: sqlite3.Connection, limit: int) -> int:
+    """Перекодировать до limit событий, сохраненных до сжатия (TEXT с JSON). Возвращает число строк"""
+    rows = conn.execute(
+        "SELECT id, data FROM events WHERE typeof(data) = 'text' LIMIT ?", (limit,)
+    ).fetchall()
+    conn.executemany(
+        "UPDATE events SET data = ? WHERE id = ?",
+        [(encode_event(json.loads(row['data'])), row['id']) for row in rows]
+    )
+    return len(rows)
+
+
+def incremental_vacuum_tx(conn: sqlite3.Connection, max_pages: int) -> int:
+    """Вернуть файловой системе до max_pages свободных страниц. Возвращает освобожденные байты"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+    conn.execute(f"PRAGMA incremental_vacuum({int(max_pages)})").fetchall()
+    after = conn.execute("PRAGMA page_count").fetchone()[0]
+    return (before - after) * page_size
+
+
+def save_event(device_id: str, event_type: str, timestamp: str, data: Union[dict, bytes]):
+    """Сохранить событие в таблицу events"""
+    with connection(layout.shard_for(device_id)) as conn:
+        save_event_tx(conn, device_id, event_type, timestamp, data)
+
+
+def update_device(device_id: str, data: dict, default_name: Optional[str] = None):
+    """Обновить или создать запись устройства"""
+    with connection() as conn:
+        update_device_tx(conn, device_id, data, default_name)
 
 
 def save_sms(device_id: str, timestamp: str, sender: str, message: str):
     """Сохранить SMS в таблицу sms_logs"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        INSERT INTO sms_logs (device_id, timestamp, sender, message)
-        VALUES (?, ?, ?, ?)
-    """, (device_id, timestamp, sender, message))
+    with connection(layout.shard_for(device_id)) as conn:
+        save_sms_tx(conn, device_id, timestamp, sender, message)
+
+
+def run_write_batch(conn: sqlite3.Connection, batch: List[List[tuple]]) -> List[tuple]:
+    """
+    Выполнить пакет запросов на запись в одной транзакции (групповой коммит).
     
-    conn.commit()
-    conn.close()
+    batch - список запросов, каждый запрос - список операций (функция_tx, args).
+    Каждый запрос выполняется в своей точке сохранения: ошибка одного запроса
+    откатывает только его операции, остальные фиксируются общим COMMIT.
+    Возвращает для каждого запроса (результаты операций, исключение или None)
+    """
+    outcomes = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for operations in batch:
+            conn.execute("SAVEPOINT request")
+            hooks_before = len(conn.commit_hooks)
+            try:
+                results = [func(conn, *args) for func, args in operations]
+            except Exception as e:
+                conn.execute("ROLLBACK TO request")
+                conn.execute("RELEASE request")
+                # Действия откатанного запроса выполнять не нужно
+                del conn.commit_hooks[hooks_before:]
+                outcomes.append((None, e))
+            else:
+                conn.execute("RELEASE request")
+                outcomes.append((results, None))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.commit_hooks.clear()
+        raise
+    conn.run_commit_hooks()
+    return outcomes
+
+
+def open_writer_connection(database: Optional[str] = None) -> sqlite3.Connection:
+    """
+    Открыть выделенное соединение для писателя файла database (по умолчанию - каталога).
+    Транзакциями управляет run_write_batch (autocommit-режим драйвера)
+    """
+    conn = _open_connection(database or layout.catalog, _pragma_settings())
+    conn.isolation_level = None
+    return conn
+
+
+# Колонки устройства для API. online вычисляется SQLite по индексированному last_seen_ts
+_DEVICE_COLUMNS = """
+    id, name, battery, signal_strength, network_type, internet, last_seen, last_seen_ts, row_version,
+    (last_seen_ts IS NOT NULL AND last_seen_ts >= ?) AS online
+"""
+
+
+def _dict_row(cursor: sqlite3.Cursor, row: tuple) -> Dict:
+    """Фабрика строк-словарей: строка сразу готова к JSON-ответу без копирования из sqlite3.Row"""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def _fetch_dicts(conn: sqlite3.Connection, sql: str, params=()) -> List[Dict]:
+    """Выполнить запрос и получить строки как словари"""
+    cursor = conn.cursor()
+    cursor.row_factory = _dict_row
+    return cursor.execute(sql, params).fetchall()
+
+
+def _device_from_row(row: sqlite3.Row) -> Dict:
+    device = dict(row)
+    device['online'] = bool(device['online'])
+    return device
+
+
+def _online_since() -> int:
+    """Граница online статуса в Unix-времени"""
+    return int(datetime.now().timestamp()) - ONLINE_THRESHOLD_SECONDS
+
+
+def warm_registry():
+    """Заполнить реестр устройств и индекс привязок в памяти (вызывается при старте сервера)"""
+    with connection() as conn:
+        # Строки и версия из одного снимка базы
+        conn.execute("BEGIN")
+        version = conn.execute(
+            "SELECT version FROM table_versions WHERE name = 'devices'"
+        ).fetchone()['version']
+        rows = conn.execute("SELECT * FROM devices ORDER BY rowid").fetchall()
+    registry.load(rows, version or 0)
+    # Привязки, измененные другим процессом (бот в режиме polling), видны не позже чем через TTL
+    bindings.ttl = float(os.getenv('BINDINGS_CACHE_TTL_SECONDS', '10'))
+    _reload_bindings()
 
 
 def get_all_devices() -> List[Dict]:
     """Получить список всех устройств с автоопределением online статуса"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    online_since = _online_since()
+    if registry.loaded:
+        return [record.to_dict(online_since) for record in registry.records()]
     
-    cursor.execute("SELECT * FROM devices")
-    rows = cursor.fetchall()
+    with connection() as conn:
+        rows = conn.execute(f"SELECT {_DEVICE_COLUMNS} FROM devices", (online_since,)).fetchall()
     
-    devices = []
-    now = datetime.now()
+    return [_device_from_row(row) for row in rows]
+
+
+def get_devices_version() -> Dict:
+    """
+    Версия списка устройств для ETag: счетчик изменений таблицы devices и число
+    устройств онлайн. Без записей устройства могут только уходить в оффлайн,
+    поэтому пара (version, online_count) однозначно определяет ответ /devices
+    """
+    if registry.loaded:
+        online_since = _online_since()
+        return {
+            'version': registry.version,
+            'online_count': sum(1 for record in registry.records() if record.is_online(online_since))
+        }
     
-    for row in rows:
-        device = dict(row)
-        
-        # Автоопределение online статуса (последнее обновление менее 35 минут назад)
-        if device['last_seen']:
-            try:
-                # Пробуем разные форматы даты
-                last_seen = None
-                
-                # Формат: "14.10.2025 12:00:00"
-                try:
-                    last_seen = datetime.strptime(device['last_seen'], "%d.%m.%Y %H:%M:%S")
-                except:
-                    pass
-                
-                # Формат ISO: "2025-10-14T12:00:00"
-                if not last_seen:
-                    try:
-                        last_seen = datetime.fromisoformat(device['last_seen'])
-                    except:
-                        pass
-                
-                if last_seen:
-                    diff_minutes = (now - last_seen).total_seconds() / 60
-                    device['online'] = diff_minutes < 20
-                else:
-                    device['online'] = False
-            except Exception as e:
-                print(f"⚠️ Ошибка парсинга даты для устройства {device.get('id')}: {e}")
-                device['online'] = False
-        else:
-            device['online'] = False
-        
-        devices.append(device)
+    with connection() as conn:
+        row = conn.execute("""
+            SELECT
+                (SELECT version FROM table_versions WHERE name = 'devices') AS version,
+                (SELECT COUNT(*) FROM devices WHERE last_seen_ts >= ?) AS online_count
+        """, (_online_since(),)).fetchone()
+    return {'version': row['version'] or 0, 'online_count': row['online_count']}
+
+
+def get_devices_changes(since_version: int) -> Dict:
+    """
+    Изменения списка устройств после версии since_version:
+    {'version': текущая версия, 'devices': измененные устройства, 'online_ids': ID устройств онлайн}
+    """
+    online_since = _online_since()
+    if registry.loaded:
+        version = registry.version
+        records = registry.records()
+        return {
+            'version': version,
+            'devices': [
+                record.to_dict(online_since) for record in records
+                if since_version < record.row_version <= version
+            ],
+            'online_ids': [record.id for record in records if record.is_online(online_since)]
+        }
     
-    conn.close()
-    return devices
+    with connection() as conn:
+        # Все чтения из одного снимка базы, чтобы версия соответствовала строкам
+        conn.execute("BEGIN")
+        version = conn.execute(
+            "SELECT version FROM table_versions WHERE name = 'devices'"
+        ).fetchone()['version']
+        rows = conn.execute(
+            f"SELECT {_DEVICE_COLUMNS} FROM devices WHERE row_version > ?",
+            (online_since, since_version)
+        ).fetchall()
+        online_ids = [
+            row['id'] for row in conn.execute(
+                "SELECT id FROM devices WHERE last_seen_ts >= ?", (online_since,)
+            )
+        ]
+    return {
+        'version': version or 0,
+        'devices': [_device_from_row(row) for row in rows],
+        'online_ids': online_ids
+    }
 
 
 def get_device_by_id(device_id: str) -> Optional[Dict]:
     """Получить информацию о конкретном устройстве"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    online_since = _online_since()
+    if registry.loaded:
+        record = registry.get(device_id)
+        return record.to_dict(online_since) if record else None
     
-    cursor.execute("SELECT * FROM devices WHERE id = ?", (device_id,))
-    row = cursor.fetchone()
+    with connection() as conn:
+        row = conn.execute(
+            f"SELECT {_DEVICE_COLUMNS} FROM devices WHERE id = ?",
+            (online_since, device_id)
+        ).fetchone()
     
     if not row:
-        conn.close()
         return None
     
-    device = dict(row)
-    
-    # Автоопределение online статуса
-    if device['last_seen']:
-        try:
-            # Пробуем разные форматы даты
-            last_seen = None
-            
-            # Формат: "14.10.2025 12:00:00"
-            try:
-                last_seen = datetime.strptime(device['last_seen'], "%d.%m.%Y %H:%M:%S")
-            except:
-                pass
-            
-            # Формат ISO: "2025-10-14T12:00:00"
-            if not last_seen:
-                try:
-                    last_seen = datetime.fromisoformat(device['last_seen'])
-                except:
-                    pass
-            
-            if last_seen:
-                diff_minutes = (datetime.now() - last_seen).total_seconds() / 60
-                device['online'] = diff_minutes < 20
-            else:
-                device['online'] = False
-        except Exception as e:
-            print(f"⚠️ Ошибка парсинга даты для устройства {device_id}: {e}")
-            device['online'] = False
+    return _device_from_row(row)
+
+
+class AmbiguousDeviceName(Exception):
+    """Имя принадлежит нескольким устройствам - определить ID по имени нельзя"""
+
+    def __init__(self, name: str, device_ids: List[str]):
+        super().__init__(f"Имя '{name}' принадлежит нескольким устройствам: {', '.join(device_ids)}")
+        self.name = name
+        self.device_ids = device_ids
+
+
+def find_device_id_by_name(name: str) -> Optional[str]:
+    """
+    Найти ID устройства по имени (для SMS событий без device.id).
+    Имена не уникальны: если имя носят несколько устройств, бросает AmbiguousDeviceName
+    """
+    if registry.loaded:
+        device_ids = registry.ids_by_name(name)
     else:
-        device['online'] = False
+        with connection() as conn:
+            device_ids = [
+                row['id'] for row in conn.execute(
+                    "SELECT id FROM devices WHERE name = ? ORDER BY id", (name,)
+                )
+            ]
     
-    conn.close()
-    return device
+    if len(device_ids) > 1:
+        raise AmbiguousDeviceName(name, device_ids)
+    return device_ids[0] if device_ids else None
 
 
-def get_device_sms(device_id: str) -> List[Dict]:
-    """Получить все SMS для конкретного устройства"""
-    conn = get_connection()
-    cursor = conn.cursor()
+# Размер страницы истории SMS по умолчанию и максимальный
+SMS_PAGE_SIZE = 50
+SMS_PAGE_SIZE_MAX = 500
+
+
+def get_device_sms(
+    device_id: str,
+    limit: int = SMS_PAGE_SIZE,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    from_ts: Optional[int] = None,
+    to_ts: Optional[int] = None
+) -> Dict:
+    """
+    Получить страницу SMS устройства (новые сверху).
+    
+    Страницы строятся по курсору id (порядок поступления), а не по смещению,
+    поэтому время запроса не зависит от объема истории:
+    - before_id - более старые SMS (прокрутка вниз)
+    - after_id - более новые SMS (новые поступления)
+    Возвращает {'sms': [...], 'next_cursor': id или None}. next_cursor передается
+    в тот же параметр (before_id или after_id) для получения следующей страницы.
+    from_ts/to_ts дополнительно ограничивают период
+    """
+    limit = max(1, min(limit, SMS_PAGE_SIZE_MAX))
+    conditions = ["device_id = ?"]
+    params = [device_id]
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+    if from_ts is not None:
+        conditions.append("timestamp_ts >= ?")
+        params.append(from_ts)
+    if to_ts is not None:
+        conditions.append("timestamp_ts <= ?")
+        params.append(to_ts)
     
-    cursor.execute("""
-        SELECT * FROM sms_logs 
-        WHERE device_id = ? 
-        ORDER BY timestamp DESC
-    """, (device_id,))
+    # Новые SMS забираем от самых старых, чтобы продолжать с курсора без пропусков
+    order = "ASC" if after_id is not None and before_id is None else "DESC"
+    params.append(limit)
     
-    rows = cursor.fetchall()
-    sms_list = [dict(row) for row in rows]
+    with connection(layout.shard_for(device_id)) as conn:
+        sms_list = _fetch_dicts(conn, f"""
+            SELECT * FROM sms_logs 
+            WHERE {' AND '.join(conditions)}
+            ORDER BY id {order}
+            LIMIT ?
+        """, params)
     
-    conn.close()
-    return sms_list
+    next_cursor = sms_list[-1]['id'] if len(sms_list) == limit else None
+    if order == "ASC":
+        sms_list.reverse()
+    
+    return {'sms': sms_list, 'next_cursor': next_cursor}
+
+
+def get_device_events(device_id: str, limit: int = 100, before_id: Optional[int] = None) -> List[Dict]:
+    """Получить события устройства из журнала (новые сверху) с раскодированными данными"""
+    params = [device_id]
+    condition = ""
+    if before_id is not None:
+        condition = "AND id < ?"
+        params.append(before_id)
+    params.append(limit)
+    
+    with connection(layout.shard_for(device_id)) as conn:
+        events = _fetch_dicts(conn, f"""
+            SELECT id, device_id, type, timestamp, timestamp_ts, data FROM events
+            WHERE device_id = ? {condition}
+            ORDER BY id DESC
+            LIMIT ?
+        """, params)
+    
+    for event in events:
+        event['data'] = decode_event(event['data'])
+    return events
+
+
+# Размер страницы результатов поиска SMS по умолчанию и максимальный
+SMS_SEARCH_PAGE_SIZE = 20
+SMS_SEARCH_PAGE_SIZE_MAX = 100
+
+
+def build_fts_query(text: str) -> Optional[str]:
+    """
+    Преобразовать пользовательский запрос в запрос FTS5.
+    Каждое слово ищется как префикс ("kasp" найдет "Kaspi"), все слова обязательны.
+    Спецсимволы FTS5 экранируются, поэтому любой ввод безопасен
+    """
+    terms = []
+    for word in text.split():
+        word = word.replace('"', '')
+        if word:
+            terms.append(f'"{word}"*')
+    return ' '.join(terms) or None
+
+
+def search_sms(
+    text: str,
+    device_id: Optional[str] = None,
+    from_ts: Optional[int] = None,
+    to_ts: Optional[int] = None,
+    limit: int = SMS_SEARCH_PAGE_SIZE,
+    offset: int = 0
+) -> Dict:
+    """
+    Полнотекстовый поиск SMS по тексту и отправителю (лучшие совпадения сверху).
+    Возвращает {'results': [...], 'next_offset': смещение следующей страницы или None}
+    
+    Без device_id поиск идет по всем шардам: из каждого берутся первые offset + limit
+    совпадений, результаты объединяются по рангу. Ранг bm25 считается по статистике
+    своего шарда, поэтому порядок между шардами приблизительный
+    """
+    fts_query = build_fts_query(text)
+    if fts_query is None:
+        return {'results': [], 'next_offset': None}
+    
+    limit = max(1, min(limit, SMS_SEARCH_PAGE_SIZE_MAX))
+    conditions = ["sms_fts MATCH ?"]
+    params = [fts_query]
+    if device_id is not None:
+        conditions.append("s.device_id = ?")
+        params.append(device_id)
+    if from_ts is not None:
+        conditions.append("s.timestamp_ts >= ?")
+        params.append(from_ts)
+    if to_ts is not None:
+        conditions.append("s.timestamp_ts <= ?")
+        params.append(to_ts)
+    databases = [layout.shard_for(device_id)] if device_id is not None else layout.shards
+    if len(databases) == 1:
+        params.extend([limit + 1, offset])
+    else:
+        # Нужная страница может целиком оказаться в любом из шардов
+        params.extend([offset + limit + 1, 0])
+    
+    rows = []
+    for database in databases:
+        with connection(database) as conn:
+            rows.extend(_fetch_dicts(conn, f"""
+                SELECT s.id, s.device_id, s.timestamp, s.timestamp_ts, s.sender, s.message,
+                       bm25(sms_fts) AS rank
+                FROM sms_fts
+                JOIN sms_logs s ON s.id = sms_fts.rowid
+                WHERE {' AND '.join(conditions)}
+                ORDER BY rank
+                LIMIT ? OFFSET ?
+            """, params))
+    if len(databases) > 1:
+        rows.sort(key=lambda row: row['rank'])
+        rows = rows[offset:]
+    
+    results = rows[:limit]
+    next_offset = offset + limit if len(rows) > limit else None
+    return {'results': results, 'next_offset': next_offset}
+
+
+def get_device_sms_version(device_id: str) -> int:
+    """Версия истории SMS устройства для ETag - id последней SMS (записи SMS не изменяются)"""
+    with connection(layout.shard_for(device_id)) as conn:
+        row = conn.execute(
+            "SELECT MAX(id) AS last_id FROM sms_logs WHERE device_id = ?", (device_id,)
+        ).fetchone()
+    return row['last_id'] or 0
+
+
+def get_storage_stats() -> Dict:
+    """Размер файлов базы (каталог и шарды) и свободное место внутри них"""
+    size_bytes = 0
+    free_bytes = 0
+    for database in layout.files:
+        with connection(database) as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if database == layout.catalog:
+                auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        size_bytes += page_size * page_count
+        free_bytes += page_size * freelist_count
+    return {
+        'size_bytes': size_bytes,
+        'free_bytes': free_bytes,
+        'auto_vacuum': {0: 'NONE', 1: 'FULL', 2: 'INCREMENTAL'}.get(auto_vacuum, str(auto_vacuum)),
+        'files': len(layout.files)
+    }
+
+
+def get_due_notifications(database: str, now_ts: float, limit: int) -> List[Dict]:
+    """
+    Уведомления файла database, которые пора отправить (по времени SMS).
+    Если SMS уже нет, sender/message равны None
+    """
+    with connection(database) as conn:
+        return _fetch_dicts(conn, """
+            SELECT o.id, o.sms_id, o.device_id, o.attempts, o.done_chats,
+                   s.timestamp, s.sender, s.message
+            FROM notification_outbox o
+            LEFT JOIN sms_logs s ON s.id = o.sms_id
+            WHERE o.status = 'pending' AND o.next_attempt_ts <= ?
+            ORDER BY s.timestamp_ts IS NULL, s.timestamp_ts, o.id
+            LIMIT ?
+        """, (now_ts, limit))
+
+
+def get_expired_events_boundary(database: str, event_type: str, cutoff_ts: int) -> Optional[int]:
+    """
+    Наибольший id устаревшего события типа event_type в файле database (None - таких нет).
+    Вычисляется до удаления и ограничивает удаление событий без времени
+    """
+    with connection(database) as conn:
+        row = conn.execute(
+            "SELECT MAX(id) FROM events WHERE type = ? AND timestamp_ts < ?", (event_type, cutoff_ts)
+        ).fetchone()
+        return row[0]
+
+
+def get_outbox_stats() -> Dict[str, int]:
+    """Число уведомлений в очереди по статусам (по всем шардам)"""
+    stats = {'pending': 0, 'delivered': 0, 'failed': 0}
+    for database in layout.shards:
+        with connection(database) as conn:
+            for row in conn.execute("SELECT status, COUNT(*) AS count FROM notification_outbox GROUP BY status"):
+                stats[row['status']] = stats.get(row['status'], 0) + row['count']
+    return stats
 
 
 # ===== Функции для работы с привязками устройств к Telegram чатам =====
 
+def _reload_bindings():
+    """Перечитать индекс привязок из базы"""
+    generation = bindings.generation
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT device_id, chat_id FROM device_chat_bindings ORDER BY id"
+        ).fetchall()
+    bindings.load(rows, generation)
+
+
+def _bindings_ready() -> bool:
+    """Актуален ли индекс привязок (перечитывает его после /add и /remove и по истечении TTL)"""
+    if bindings.enabled and not bindings.fresh:
+        _reload_bindings()
+    return bindings.fresh
+
+
 def add_device_binding(device_id: str, chat_id: int) -> bool:
     """Привязать устройство к Telegram чату"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("""
-            INSERT INTO device_chat_bindings (device_id, chat_id, created_at)
-            VALUES (?, ?, ?)
-        """, (device_id, chat_id, datetime.now().isoformat()))
-        conn.commit()
-        conn.close()
+        with connection() as conn:
+            conn.execute("""
+                INSERT INTO device_chat_bindings (device_id, chat_id, created_at)
+                VALUES (?, ?, ?)
+            """, (device_id, chat_id, datetime.now().isoformat()))
+            conn.on_commit(bindings.invalidate)
         return True
     except sqlite3.IntegrityError:
         # Привязка уже существует
-        conn.close()
         return False
 
 
 def remove_device_binding(device_id: str, chat_id: int) -> bool:
     """Отвязать устройство от Telegram чата"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        DELETE FROM device_chat_bindings 
-        WHERE device_id = ? AND chat_id = ?
-    """, (device_id, chat_id))
-    
-    deleted = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.execute("""
+            DELETE FROM device_chat_bindings 
+            WHERE device_id = ? AND chat_id = ?
+        """, (device_id, chat_id))
+        deleted = cursor.rowcount > 0
+        if deleted:
+            conn.on_commit(bindings.invalidate)
     return deleted
 
 
 def get_chat_bindings(chat_id: int) -> List[str]:
     """Получить список устройств, привязанных к чату"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    if _bindings_ready():
+        return bindings.chat_devices(chat_id)
     
-    cursor.execute("""
-        SELECT device_id FROM device_chat_bindings 
-        WHERE chat_id = ?
-    """, (chat_id,))
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT device_id FROM device_chat_bindings 
+            WHERE chat_id = ?
+        """, (chat_id,)).fetchall()
     
-    rows = cursor.fetchall()
-    device_ids = [row['device_id'] for row in rows]
-    
-    conn.close()
-    return device_ids
+    return [row['device_id'] for row in rows]
 
 
 def get_device_chats(device_id: str) -> List[int]:
     """Получить список чатов, к которым привязано устройство"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    if _bindings_ready():
+        return bindings.device_chats(device_id)
     
-    cursor.execute("""
-        SELECT chat_id FROM device_chat_bindings 
-        WHERE device_id = ?
-    """, (device_id,))
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT chat_id FROM device_chat_bindings 
+            WHERE device_id = ?
+        """, (device_id,)).fetchall()
     
-    rows = cursor.fetchall()
-    chat_ids = [row['chat_id'] for row in rows]
-    
-    conn.close()
-    return chat_ids
+    return [row['chat_id'] for row in rows]
+
+
+# ===== Асинхронные обертки для использования из FastAPI и aiogram =====
+# Запросы к SQLite выполняются в отдельном пуле потоков,
+# чтобы fsync и ожидание блокировок не останавливали event loop
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Получить пул потоков для запросов к базе данных"""
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv('DB_EXECUTOR_WORKERS', os.getenv('SQLITE_POOL_SIZE', '8'))),
+                thread_name_prefix='db'
+            )
+        return _executor
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполнить синхронную функцию работы с базой в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _make_async(func):
+    """Создать асинхронный аналог функции модуля"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    wrapper.__name__ = f"{func.__name__}_async"
+    wrapper.__qualname__ = wrapper.__name__
+    return wrapper
+
+
+def _make_memory_async(func, in_memory):
+    """
+    Асинхронный аналог чтения, которое может обслуживаться из памяти:
+    если in_memory() истинно - вызов без пула потоков, иначе - запрос к базе в пуле
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if in_memory():
+            return func(*args, **kwargs)
+        return await run_db(func, *args, **kwargs)
+    wrapper.__name__ = f"{func.__name__}_async"
+    wrapper.__qualname__ = wrapper.__name__
+    return wrapper
+
+
+def _registry_loaded() -> bool:
+    return registry.loaded
+
+
+def _bindings_fresh() -> bool:
+    return bindings.fresh
+
 
+init_database_async = _make_async(init_database)
+warm_registry_async = _make_async(warm_registry)
+get_all_devices_async = _make_memory_async(get_all_devices, _registry_loaded)
+get_device_by_id_async = _make_memory_async(get_device_by_id, _registry_loaded)
+find_device_id_by_name_async = _make_memory_async(find_device_id_by_name, _registry_loaded)
+get_device_sms_async = _make_async(get_device_sms)
+get_devices_version_async = _make_memory_async(get_devices_version, _registry_loaded)
+get_devices_changes_async = _make_memory_async(get_devices_changes, _registry_loaded)
+get_device_sms_version_async = _make_async(get_device_sms_version)
+get_device_events_async = _make_async(get_device_events)
+search_sms_async = _make_async(search_sms)
+get_storage_stats_async = _make_async(get_storage_stats)
+get_due_notifications_async = _make_async(get_due_notifications)
+get_outbox_stats_async = _make_async(get_outbox_stats)
+get_expired_events_boundary_async = _make_async(get_expired_events_boundary)
+add_device_binding_async = _make_async(add_device_binding)
+remove_device_binding_async = _make_async(remove_device_binding)
+get_chat_bindings_async = _make_memory_async(get_chat_bindings, _bindings_fresh)
+get_device_chats_async = _make_memory_async(get_device_chats, _bindings_fresh)
@@ -0,0 +1,202 @@
+"""
+Реестр устройств и индекс привязок к чатам в памяти процесса
+
+Несколько сотен строк таблицы devices держатся в памяти: реестр заполняется
+при старте сервера и обновляется после каждой зафиксированной записи
+устройства (write-through из app/database.py). Чтения /devices, /device/{id}
+и уведомлений обслуживаются без обращения к SQLite.
+
+Привязки устройств к чатам (device_chat_bindings) хранятся так же,
+в индексе в обе стороны, который сбрасывается при /add и /remove.
+
+Реестр рассчитан на один процесс-писатель (один воркер uvicorn). Процессы,
+которые его не заполнили (например, бот в режиме polling), читают из базы.
+"""
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+class DeviceRecord:
+    """Компактная запись устройства"""
+
+    __slots__ = (
+        'id', 'name', 'battery', 'signal_strength', 'network_type',
+        'internet', 'last_seen', 'last_seen_ts', 'row_version'
+    )
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.name = row['name']
+        self.battery = row['battery']
+        self.signal_strength = row['signal_strength']
+        self.network_type = row['network_type']
+        self.internet = row['internet']
+        self.last_seen = row['last_seen']
+        self.last_seen_ts = row['last_seen_ts']
+        self.row_version = row['row_version']
+
+    def is_online(self, online_since: int) -> bool:
+        return self.last_seen_ts is not None and self.last_seen_ts >= online_since
+
+    def to_dict(self, online_since: int) -> Dict:
+        """Словарь в формате API (как строка devices с вычисленным online)"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'battery': self.battery,
+            'signal_strength': self.signal_strength,
+            'network_type': self.network_type,
+            'internet': self.internet,
+            'last_seen': self.last_seen,
+            'last_seen_ts': self.last_seen_ts,
+            'row_version': self.row_version,
+            'online': self.is_online(online_since)
+        }
+
+
+class DeviceRegistry:
+    """Устройства по ID и версия таблицы devices"""
+
+    def __init__(self):
+        self._devices: Dict[str, DeviceRecord] = {}
+        # Имя -> ID устройств с этим именем (имена не уникальны)
+        self._by_name: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.version = 0
+        self.loaded = False
+
+    def load(self, rows: Iterable, version: int):
+        """Заполнить реестр из базы (при старте)"""
+        devices = {}
+        by_name: Dict[str, Set[str]] = {}
+        for row in rows:
+            record = DeviceRecord(row)
+            devices[record.id] = record
+            if record.name:
+                by_name.setdefault(record.name, set()).add(record.id)
+        with self._lock:
+            self._devices = devices
+            self._by_name = by_name
+            self.version = version
+            self.loaded = True
+
+    def clear(self):
+        with self._lock:
+            self._devices = {}
+            self._by_name = {}
+            self.version = 0
+            self.loaded = False
+
+    def apply(self, row):
+        """Применить зафиксированную запись устройства"""
+        record = DeviceRecord(row)
+        with self._lock:
+            # Записи могут применяться не в порядке версий - старую версию не восстанавливаем
+            current = self._devices.get(record.id)
+            if current is None or current.row_version <= record.row_version:
+                self._devices[record.id] = record
+                if current is None or current.name != record.name:
+                    self._rename(record.id, current.name if current else None, record.name)
+            if record.row_version > self.version:
+                self.version = record.row_version
+
+    def _rename(self, device_id: str, old_name: Optional[str], new_name: Optional[str]):
+        if old_name:
+            ids = self._by_name.get(old_name)
+            if ids is not None:
+                ids.discard(device_id)
+                if not ids:
+                    del self._by_name[old_name]
+        if new_name:
+            self._by_name.setdefault(new_name, set()).add(device_id)
+
+    def get(self, device_id: str) -> Optional[DeviceRecord]:
+        return self._devices.get(device_id)
+
+    def ids_by_name(self, name: str) -> List[str]:
+        """ID устройств с указанным именем"""
+        with self._lock:
+            return sorted(self._by_name.get(name, ()))
+
+    def records(self) -> List[DeviceRecord]:
+        """Снимок всех записей (в порядке добавления)"""
+        with self._lock:
+            return list(self._devices.values())
+
+    def __len__(self):
+        return len(self._devices)
+
+
+# Реестр процесса
+registry = DeviceRegistry()
+
+
+class BindingIndex:
+    """
+    Привязки устройств к чатам в обе стороны: устройство -> чаты и чат -> устройства.
+
+    При /add и /remove индекс помечается устаревшим и перечитывается из базы
+    при следующем чтении. Счетчик поколений не дает перезагрузке, начатой до
+    изменения, пометить индекс актуальным.
+
+    Привязки может менять и другой процесс (бот в режиме polling,
+    app/telegram_bot.py), чьи записи этот процесс не видит. Поэтому индекс
+    считается устаревшим и через ttl секунд после загрузки (0 - без срока).
+    """
+
+    def __init__(self, ttl: float = 0):
+        self._by_device: Dict[str, Tuple[int, ...]] = {}
+        self._by_chat: Dict[int, Tuple[str, ...]] = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.enabled = False
+        self._stale = True
+        self.ttl = ttl
+        self._loaded_at = 0.0
+
+    @property
+    def fresh(self) -> bool:
+        if not self.enabled or self._stale:
+            return False
+        return self.ttl <= 0 or time.monotonic() - self._loaded_at < self.ttl
+
+    def load(self, rows: Iterable, generation: int):
+        """Заполнить индекс строками (device_id, chat_id), прочитанными в поколении generation"""
+        by_device: Dict[str, List[int]] = {}
+        by_chat: Dict[int, List[str]] = {}
+        for row in rows:
+            by_device.setdefault(row['device_id'], []).append(row['chat_id'])
+            by_chat.setdefault(row['chat_id'], []).append(row['device_id'])
+        with self._lock:
+            if generation != self.generation:
+                # Пока читали базу, привязки изменились
+                return
+            self._by_device = {key: tuple(value) for key, value in by_device.items()}
+            self._by_chat = {key: tuple(value) for key, value in by_chat.items()}
+            self.enabled = True
+            self._stale = False
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._stale = True
+
+    def clear(self):
+        with self._lock:
+            self._by_device = {}
+            self._by_chat = {}
+            self.generation += 1
+            self.enabled = False
+            self._stale = True
+
+    def device_chats(self, device_id: str) -> List[int]:
+        return list(self._by_device.get(device_id, ()))
+
+    def chat_devices(self, chat_id: int) -> List[str]:
+        return list(self._by_chat.get(chat_id, ()))
+
+
+# Индекс привязок процесса
+bindings = BindingIndex()
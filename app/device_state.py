@@ -0,0 +1,120 @@
+"""
+Отложенная запись состояния устройств в каталог
+
+Каждое событие обновляет запись устройства (батарея, сеть, last_seen) в таблице
+devices каталога. При DATABASE_SHARDS > 1 запись в транзакции события пускала бы
+весь прием через блокировку записи одного файла каталога.
+
+Поэтому при шардировании для известных устройств (есть в реестре) событие
+пишется только в свой шард, а состояние устройства после фиксации события запоминается здесь
+(record) и записывается в каталог пакетом раз в DEVICE_STATE_FLUSH_MS:
+одна транзакция на все устройства, по одной записи на устройство - последнее
+состояние. Реестр в памяти и /devices получают новое состояние после записи
+пакета (с задержкой не больше интервала).
+
+Создание устройства и изменение имени по-прежнему пишутся в каталог сразу.
+При остановке сервера накопленное состояние записывается; при аварийном
+завершении теряется состояние не больше чем за один интервал - события и SMS
+уже сохранены в шардах. Одной транзакцией с событием (единица работы) состояние
+устройства фиксируется только без шардирования: при DATABASE_SHARDS=1 каталог и
+шард - один файл, и отложенная запись не включается. DEVICE_STATE_FLUSH_MS=0
+отключает ее и при шардировании.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, Optional
+
+from app.database import layout, update_device_tx
+from app.device_registry import registry
+from app import ingest_writer
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceStateWriter:
+    """Накопление состояния устройств и периодическая запись в каталог"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # ID устройства -> последние данные для update_device_tx
+        self._pending: Dict[str, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop(), name='device-state')
+
+    async def stop(self):
+        """Остановить задачу и записать накопленное состояние"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def record(self, device_id: str, data: dict):
+        self._pending[device_id] = data
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка записи состояния устройств")
+
+    async def flush(self) -> int:
+        """Записать накопленное состояние одной транзакцией. Возвращает число устройств"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        try:
+            await ingest_writer.submit([
+                (update_device_tx, (device_id, data)) for device_id, data in pending.items()
+            ])
+        except BaseException:
+            # Повторим в следующий раз, если за это время не пришло более новое состояние
+            for device_id, data in pending.items():
+                self._pending.setdefault(device_id, data)
+            raise
+        return len(pending)
+
+
+_writer: Optional[DeviceStateWriter] = None
+
+
+def start_device_state():
+    """Запустить отложенную запись состояния (вызывается при старте приложения, только при шардировании)"""
+    global _writer
+    if layout.shard_count == 1:
+        return
+    interval = float(os.getenv('DEVICE_STATE_FLUSH_MS', '500')) / 1000
+    if interval <= 0:
+        logger.info("Отложенная запись состояния устройств отключена")
+        return
+    _writer = DeviceStateWriter(interval)
+    _writer.start()
+
+
+async def stop_device_state():
+    """Записать накопленное состояние и остановить задачу (до остановки писателей)"""
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        await writer.stop()
+
+
+def defer(device_id: str) -> bool:
+    """Записывать ли состояние устройства отложенно (устройство уже есть в каталоге)"""
+    return _writer is not None and registry.get(device_id) is not None
+
+
+def record(device_id: str, data: dict):
+    """Запомнить состояние устройства после фиксации события"""
+    if _writer is not None:
+        _writer.record(device_id, data)
@@ -0,0 +1,69 @@
+"""
+Компактное хранение событий в журнале events
+
+Полезная нагрузка события сохраняется как BLOB:
+    1 байт - версия формата (номер словаря) + zlib-поток компактного JSON
+
+Сжатие использует заранее подготовленный словарь (zdict) из типичных фрагментов
+событий устройств: ключи, вложенный блок device, частые значения сети.
+Поэтому даже короткие heartbeat-события сжимаются в несколько раз,
+а каждое событие восстанавливается независимо от остальных.
+
+Старые записи (TEXT с JSON) читаются decode_event без изменений.
+"""
+import json
+import zlib
+from typing import Union
+
+
+# Словари сжатия по версиям формата. Выпущенные словари НЕ изменяются:
+# для нового словаря добавляется новая версия, старые нужны для чтения записей.
+# Самые частые фрагменты - в конце словаря (zlib кодирует их более короткими ссылками)
+_DICTIONARIES = {
+    1: (
+        '"network":{"hasSignal":true,"signalStrength":4,"networkType":"4G (LTE) (Tele2)",'
+        '"country":"KZ","canReceiveSms":true},'
+        '"internet":{"connected":true,"type":"Мобильные данные (4G (LTE))"},'
+        '"internet":{"connected":false,"type":"Wi-Fi"},'
+        '"networkType":"3G","networkType":"5G","networkType":"Unknown",'
+        '"connectionType":"Mobile","connectionType":"Unknown","internetConnected":false,'
+        '{"type":"boot_completed","timestamp":"'
+        '{"type":"sms","timestamp":"","from":"Halyk","from":"+7705","message":"Ваш код подтверждения: ",'
+        '"device":{"name":"","id":"","battery":'
+        '{"type":"device_status","timestamp":"'
+        '.2025 ","device":{"id":"","name":"Device ","battery":'
+        ',"hasSignal":true,"signalStrength":4,"networkType":"4G (LTE)",'
+        '"internetConnected":true,"connectionType":"Wi-Fi"}}'
+    ).encode('utf-8'),
+}
+
+CURRENT_VERSION = 1
+
+# Уровень сжатия: 6 - стандартный баланс скорости и размера zlib
+_COMPRESSION_LEVEL = 6
+
+
+def encode_event(data: Union[dict, bytes]) -> bytes:
+    """
+    Закодировать событие для хранения в events.data.
+    data - словарь или уже сериализованный компактный JSON в UTF-8 (BaseEvent.payload)
+    """
+    if isinstance(data, bytes):
+        payload = data
+    else:
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    compressor = zlib.compressobj(_COMPRESSION_LEVEL, zdict=_DICTIONARIES[CURRENT_VERSION])
+    return bytes([CURRENT_VERSION]) + compressor.compress(payload) + compressor.flush()
+
+
+def decode_event(value: Union[bytes, str]) -> dict:
+    """Восстановить событие из events.data (новый BLOB-формат или старый TEXT с JSON)"""
+    if isinstance(value, str):
+        return json.loads(value)
+    version = value[0]
+    dictionary = _DICTIONARIES.get(version)
+    if dictionary is None:
+        raise ValueError(f"Неизвестная версия формата события: {version}")
+    decompressor = zlib.decompressobj(zdict=dictionary)
+    payload = decompressor.decompress(value[1:]) + decompressor.flush()
+    return json.loads(payload)
@@ -0,0 +1,70 @@
+"""
+Идемпотентный прием событий
+
+Android-клиент повторяет запрос при таймауте, поэтому одно и то же событие
+может прийти несколько раз. Каждое событие получает ключ (event_key):
+  - из event_id, если клиент его передал (уникален в пределах устройства);
+  - иначе хеш device_id и содержимого события (тип, время, данные).
+
+Повтор распознается в два шага:
+  1. LRU недавно сохраненных ключей в памяти (recent_events) - повтор
+     подтверждается без обращения к базе, записи и уведомления;
+  2. уникальный индекс events.dedup_key - для повторов, которых нет в кэше
+     (после перезапуска, вытеснения или одновременных запросов): save_event_tx
+     бросает DuplicateEvent, и операции запроса откатываются.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+def event_key(device_id: str, payload: bytes, event_id: Optional[str] = None) -> bytes:
+    """Ключ идемпотентности события (16 байт)"""
+    digest = hashlib.blake2b(digest_size=16)
+    if event_id:
+        digest.update(b'id\0' + device_id.encode('utf-8') + b'\0' + event_id.encode('utf-8'))
+    else:
+        # payload - событие в исходном виде (type, timestamp и данные)
+        digest.update(b'event\0' + device_id.encode('utf-8') + b'\0' + payload)
+    return digest.digest()
+
+
+class RecentKeys:
+    """LRU ключей сохраненных событий ограниченного размера"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._keys: 'OrderedDict[bytes, None]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: bytes) -> bool:
+        with self._lock:
+            if key not in self._keys:
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def add(self, key: bytes):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+recent_events = RecentKeys(100000)
+
+
+def init_recent_events():
+    """Настроить размер кэша ключей (вызывается при старте приложения)"""
+    recent_events.clear()
+    recent_events.max_size = max(0, int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '100000')))
@@ -0,0 +1,242 @@
+"""
+Единый писатель для входящих событий (write-behind с групповым коммитом)
+
+Маршруты не пишут в SQLite сами, а ставят операции в очередь.
+Одна фоновая задача забирает запросы из очереди пакетами
+(не больше INGEST_BATCH_SIZE запросов, ожидание не дольше INGEST_MAX_DELAY_MS)
+и фиксирует весь пакет одним COMMIT - один fsync на пакет вместо одного на строку.
+Каждый запрос получает свой Future, который завершается только после COMMIT,
+поэтому HTTP-ответ по-прежнему означает, что данные сохранены.
+
+У каждого файла базы (каталог и шарды, app/storage.py) свой писатель.
+Операции запроса распределяются по файлам (database_for_operation); если запрос
+затрагивает несколько файлов, части пишутся параллельно, каждая - атомарно
+в своем файле. Общей транзакции между файлами нет: например, SMS может быть
+сохранено в шарде, а обновление устройства в каталоге - нет.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.database import (
+    connection,
+    open_writer_connection,
+    run_write_batch,
+    run_db,
+    database_for_operation,
+    layout
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Операция записи: (функция_tx(conn, *args), args)
+Operation = Tuple[Callable, tuple]
+
+
+class IngestWriter:
+    """Фоновая задача, выполняющая все записи в один файл базы через одно соединение"""
+
+    def __init__(self, database: str, batch_size: int, max_delay_ms: float, name: str = 'db-writer'):
+        self.database = database
+        self.name = name
+        self.batch_size = batch_size
+        self.max_delay = max_delay_ms / 1000
+        # Элемент очереди - список запросов (для POST /events их несколько) и его Future
+        self._queue: "asyncio.Queue[Tuple[List[List[Operation]], asyncio.Future]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._conn = None
+        # Один поток: все записи идут через одно соединение последовательно
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+        # Статистика
+        self.batches = 0
+        self.requests = 0
+
+    async def start(self):
+        """Открыть соединение и запустить фоновую задачу"""
+        loop = asyncio.get_running_loop()
+        self._conn = await loop.run_in_executor(self._thread, open_writer_connection, self.database)
+        self._task = asyncio.create_task(self._run(), name=self.name)
+
+    async def stop(self):
+        """Дописать очередь, остановить задачу и закрыть соединение"""
+        if self._task:
+            # None - сигнал остановки, он встанет в очередь после всех запросов
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        if self._conn is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._thread, self._conn.close)
+            self._conn = None
+        self._thread.shutdown(wait=True)
+
+    async def submit(self, operations: List[Operation]) -> List[Any]:
+        """
+        Поставить запрос (список операций одного события) в очередь.
+        Возвращает результаты операций после фиксации транзакции
+        """
+        results, error = (await self.submit_many([operations]))[0]
+        if error is not None:
+            raise error
+        return results
+
+    async def submit_many(self, requests: List[List[Operation]]) -> List[Tuple[Optional[List[Any]], Optional[Exception]]]:
+        """
+        Поставить несколько запросов в очередь одним элементом: все они попадут
+        в одну транзакцию, каждый - в свою точку сохранения.
+        Возвращает для каждого запроса (результаты операций, исключение или None)
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((requests, future))
+        return await future
+
+    async def _collect_batch(self, first) -> Tuple[list, bool]:
+        """Собрать пакет: сначала все, что уже в очереди, затем ждать не дольше max_delay"""
+        batch = [first]
+        stop = False
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch, stop = await self._collect_batch(first)
+
+            requests = [operations for item, _ in batch for operations in item]
+            try:
+                outcomes = await loop.run_in_executor(self._thread, run_write_batch, self._conn, requests)
+            except Exception as e:
+                # Не удалось зафиксировать пакет - ошибка для всех запросов пакета
+                logger.error(
+                    "Ошибка записи пакета: %s", e,
+                    extra={'writer': self.name, 'requests': len(requests)}
+                )
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.requests += len(requests)
+            position = 0
+            for item, future in batch:
+                item_outcomes = outcomes[position:position + len(item)]
+                position += len(item)
+                if not future.done():
+                    future.set_result(item_outcomes)
+
+
+# Писатели по файлам базы
+_writers: Dict[str, IngestWriter] = {}
+
+
+async def start_writer():
+    """Запустить писателей для всех файлов базы (вызывается при старте приложения)"""
+    for index, database in enumerate(layout.files):
+        writer = IngestWriter(
+            database,
+            batch_size=int(os.getenv('INGEST_BATCH_SIZE', '256')),
+            max_delay_ms=float(os.getenv('INGEST_MAX_DELAY_MS', '2')),
+            name=f'db-writer-{index}'
+        )
+        await writer.start()
+        _writers[database] = writer
+    logger.info("Писатели событий запущены", extra={'writers': len(_writers)})
+
+
+async def stop_writer():
+    """Остановить писателей, дописав очереди (вызывается при остановке)"""
+    if not _writers:
+        return
+    writers = list(_writers.values())
+    _writers.clear()
+    await asyncio.gather(*(writer.stop() for writer in writers))
+    requests = sum(writer.requests for writer in writers)
+    batches = sum(writer.batches for writer in writers)
+    logger.info("Писатели остановлены", extra={'requests': requests, 'batches': batches})
+
+
+async def submit(operations: List[Operation], database: Optional[str] = None) -> List[Any]:
+    """
+    Выполнить операции записи одного запроса (в каждом файле базы - в одной транзакции).
+    database - файл для всех операций; по умолчанию файл определяется по каждой операции.
+    Если писатели не запущены (например, отдельный процесс бота) - пишем напрямую
+    """
+    results, error = (await submit_many([operations], database))[0]
+    if error is not None:
+        raise error
+    return results
+
+
+async def submit_many(requests: List[List[Operation]],
+                      database: Optional[str] = None) -> List[Tuple[Optional[List[Any]], Optional[Exception]]]:
+    """
+    Выполнить несколько запросов в одной транзакции (в каждом файле базы).
+    Ошибка запроса откатывает только его операции.
+    Возвращает для каждого запроса (результаты операций, исключение или None)
+    """
+    # Файл -> [(номер запроса, [номера операций])]
+    groups: Dict[str, List[Tuple[int, List[int]]]] = {}
+    for request_index, operations in enumerate(requests):
+        by_file: Dict[str, List[int]] = {}
+        for index, (func, args) in enumerate(operations):
+            target = database or database_for_operation(func, args)
+            by_file.setdefault(target, []).append(index)
+        for target, indexes in by_file.items():
+            groups.setdefault(target, []).append((request_index, indexes))
+
+    parts = list(groups.items())
+    file_outcomes = await asyncio.gather(*(
+        _submit_to(target, [[requests[i][j] for j in indexes] for i, indexes in items])
+        for target, items in parts
+    ))
+
+    results: List[List[Any]] = [[None] * len(operations) for operations in requests]
+    errors: List[Optional[Exception]] = [None] * len(requests)
+    for (_, items), outcomes in zip(parts, file_outcomes):
+        for (request_index, indexes), (part_results, error) in zip(items, outcomes):
+            if error is not None:
+                errors[request_index] = errors[request_index] or error
+                continue
+            for j, result in zip(indexes, part_results):
+                results[request_index][j] = result
+    return [
+        (None, error) if error is not None else (request_results, None)
+        for request_results, error in zip(results, errors)
+    ]
+
+
+async def _submit_to(database: str, requests: List[List[Operation]]) -> list:
+    writer = _writers.get(database)
+    if writer is None:
+        return await run_db(_run_direct, database, requests)
+    return await writer.submit_many(requests)
+
+
+def _run_direct(database: str, requests: List[List[Operation]]) -> list:
+    with connection(database) as conn:
+        return run_write_batch(conn, requests)
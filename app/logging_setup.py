@@ -0,0 +1,186 @@
+"""
+Структурированное журналирование сервера
+
+Модули пишут в журнал через logging.getLogger(__name__). Записи логгера app
+не форматируются и не выводятся в потоке, который их создал: обработчик только
+кладет запись в очередь (QueueHandler), а отдельный поток (QueueListener)
+форматирует ее в JSON-строку и пишет в stdout. Поэтому вывод журнала
+не задерживает прием событий и не попадает в профиль горячего пути.
+Журнал запросов uvicorn (uvicorn.access) тоже выводится через эту очередь.
+
+Одна запись - одна строка JSON: time, level, logger, msg и поля из extra
+(device_id, event_type, ...). Настройки (читаются в setup_logging):
+  LOG_LEVEL                  - DEBUG, INFO, WARNING, ERROR (по умолчанию INFO)
+  LOG_QUEUE_SIZE             - размер очереди записей; при переполнении записи
+                               отбрасываются (счетчик log_records_dropped в /metrics)
+  LOG_DEVICE_STATUS_INTERVAL - не чаще одной записи о device_status на устройство
+                               за столько секунд (0 - писать каждое событие)
+  LOG_SMS_TEXT               - писать текст SMS в журнал (по умолчанию вместо
+                               текста пишется только его длина)
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from typing import Dict, List, Optional
+
+import orjson
+
+from app import metrics
+
+
+# Поле extra с текстом SMS - в журнал попадает только с LOG_SMS_TEXT=true
+SMS_TEXT_FIELD = 'sms_text'
+
+# Атрибуты LogRecord, которые не относятся к полям extra
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_log_sms_text = False
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись журнала в одну строку JSON (форматируется в потоке QueueListener)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key in _RECORD_ATTRIBUTES or key.startswith('_'):
+                continue
+            if key == SMS_TEXT_FIELD and not _log_sms_text:
+                key, value = 'sms_length', len(value or '')
+            entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return orjson.dumps(entry, default=str).decode('utf-8')
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладет запись в очередь без форматирования и без ожидания:
+    стандартный prepare форматирует сообщение в вызывающем потоке,
+    здесь фиксируется только текст сообщения (аргументы могут измениться после вызова)
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def __init__(self, log_queue: queue.SimpleQueue, max_size: int):
+        super().__init__(log_queue)
+        self.max_size = max_size
+
+    def enqueue(self, record: logging.LogRecord):
+        # SimpleQueue быстрее queue.Queue, но без ограничения размера - проверяем сами
+        if self.queue.qsize() >= self.max_size:
+            metrics.increment('log_records_dropped')
+            return
+        self.queue.put_nowait(record)
+
+
+def setup_logging():
+    """Настроить логгер app: очередь и поток вывода (вызывается при старте приложения)"""
+    global _listener, _log_sms_text
+    if _listener is not None:
+        return
+
+    _log_sms_text = _env_flag('LOG_SMS_TEXT')
+    device_status_sampler.interval = float(os.getenv('LOG_DEVICE_STATUS_INTERVAL', '300'))
+
+    # Поток и процесс в JSON не выводятся - не собираем их для каждой записи
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, output)
+
+    handler = _NonBlockingQueueHandler(log_queue, int(os.getenv('LOG_QUEUE_SIZE', '10000')))
+    logger = logging.getLogger('app')
+    logger.handlers = [handler]
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').strip().upper())
+    logger.propagate = False
+    # Журнал запросов uvicorn (строка на каждый запрос) - через ту же очередь
+    access_logger = logging.getLogger('uvicorn.access')
+    if access_logger.handlers:
+        access_logger.handlers = [handler]
+        access_logger.propagate = False
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописать оставшиеся записи и остановить поток вывода (вызывается при остановке)"""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+
+
+class DeviceSampler:
+    """
+    Выборка частых записей по устройствам: не больше одной записи
+    на устройство за interval секунд. Пропущенные записи считаются
+    и сообщаются полем skipped в следующей записи устройства.
+    Хранится не больше max_devices устройств: при заполнении сначала
+    удаляются истекшие окна, затем самое старое
+    """
+
+    def __init__(self, interval: float, max_devices: int = 10000):
+        self.interval = interval
+        self.max_devices = max_devices
+        # device_id -> [время последней записи, пропущено с тех пор];
+        # порядок - по времени последней записи (истекшие окна в начале)
+        self._state: Dict[str, List] = {}
+
+    def sample(self, device_id: str) -> Optional[int]:
+        """Число пропущенных записей, если запись нужно сделать, иначе None"""
+        if self.interval <= 0:
+            return 0
+        now = time.monotonic()
+        state = self._state.get(device_id)
+        if state is not None and now - state[0] < self.interval:
+            state[1] += 1
+            return None
+        if state is not None:
+            skipped = state[1]
+            del self._state[device_id]
+        else:
+            skipped = 0
+            if len(self._state) >= self.max_devices:
+                self._prune(now)
+        self._state[device_id] = [now, 0]
+        return skipped
+
+    def _prune(self, now: float):
+        """Удалить устройства с истекшим окном, а если их нет - самое старое"""
+        expired = []
+        for device_id, (written_at, _) in self._state.items():
+            if now - written_at < self.interval:
+                break
+            expired.append(device_id)
+        for device_id in expired:
+            del self._state[device_id]
+        if len(self._state) >= self.max_devices:
+            del self._state[next(iter(self._state))]
+
+
+device_status_sampler = DeviceSampler(300.0)
@@ -3,11 +3,13 @@ FastAPI сервер для приема данных от Android-устрой
 Принимает события трех типов: device_status, sms, boot_completed
 + Webhook для Telegram бота
 """
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, FileResponse, Response
 from contextlib import asynccontextmanager
 import uvicorn
-from typing import Dict, Any
+import orjson
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple, Union
+import logging
 import os
 
 from aiogram import Bot, Dispatcher, Router
@@ -15,17 +17,52 @@ from aiogram.types import Update
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from dotenv import load_dotenv
+from pydantic import ValidationError
 
 from app.database import (
-    init_database, 
-    save_event, 
-    update_device, 
-    save_sms,
-    get_all_devices,
-    get_device_by_id,
-    get_device_sms
+    init_pool,
+    close_pool,
+    init_database_async,
+    warm_registry_async,
+    save_event_tx,
+    update_device_tx,
+    save_sms_tx,
+    get_all_devices_async,
+    get_device_by_id_async,
+    get_device_sms_async,
+    get_devices_version_async,
+    get_devices_changes_async,
+    get_device_sms_version_async,
+    get_storage_stats_async,
+    get_outbox_stats_async,
+    search_sms_async,
+    find_device_id_by_name_async,
+    AmbiguousDeviceName,
+    DuplicateEvent,
+    parse_timestamp,
+    SMS_PAGE_SIZE,
+    SMS_PAGE_SIZE_MAX,
+    SMS_SEARCH_PAGE_SIZE,
+    SMS_SEARCH_PAGE_SIZE_MAX
 )
-from app.telegram_notifications import init_telegram_bot, send_sms_notification_async
+from app.device_registry import registry
+from app.models import (
+    parse_event as parse_event_model,
+    EVENT_MODELS,
+    BaseEvent,
+    DeviceStatusEvent,
+    SMSEvent,
+    BootCompletedEvent
+)
+from app.telegram_notifications import init_telegram_bot, close_telegram_bot, notifications_enabled, get_bot
+from app.logging_setup import setup_logging, stop_logging, device_status_sampler, SMS_TEXT_FIELD
+from app.idempotency import event_key, recent_events, init_recent_events
+from app.admission import admission, init_admission, Rejected
+from app import ingest_writer
+from app import maintenance
+from app import metrics
+from app import notification_outbox
+from app import device_state
 
 # Загружаем конфигурацию
 load_dotenv('config.env')
@@ -33,41 +70,65 @@ load_dotenv('config.env')
 # Импортируем обработчики Telegram бота
 from app import telegram_bot
 
+logger = logging.getLogger(__name__)
+
 
 # Инициализация базы данных при запуске
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
     # Startup
-    init_database()
-    print("✅ База данных инициализирована")
+    setup_logging()
+    init_pool()
+    await init_database_async()
+    logger.info("База данных инициализирована")
+    await warm_registry_async()
+    logger.info("Реестр устройств загружен в память", extra={'devices': len(registry)})
+    init_recent_events()
+    init_admission()
+    await ingest_writer.start_writer()
+    device_state.start_device_state()
+    maintenance.start_retention_job()
     
-    # Инициализация Telegram бота для уведомлений
+    # Общий Telegram бот приложения (уведомления и webhook)
     init_telegram_bot()
+    if notifications_enabled():
+        # Сразу же отправляет уведомления, оставшиеся в очереди с прошлого запуска
+        notification_outbox.start_outbox()
     
     # Настройка webhook для Telegram
     webhook_url = os.getenv('WEB_URL', 'http://localhost:8000')
-    if webhook_url and webhook_url != 'http://localhost:8000':
+    if not notifications_enabled():
+        logger.warning("Telegram бот не создан, webhook не установлен")
+    elif webhook_url and webhook_url != 'http://localhost:8000':
         try:
-            await telegram_bot.bot.set_webhook(
+            await get_bot().set_webhook(
                 url=f"{webhook_url}/telegram/webhook",
                 drop_pending_updates=True
             )
-            print(f"✅ Telegram webhook установлен: {webhook_url}/telegram/webhook")
+            logger.info("Telegram webhook установлен", extra={'url': f"{webhook_url}/telegram/webhook"})
         except Exception as e:
-            print(f"⚠️ Ошибка установки webhook: {e}")
+            logger.warning("Ошибка установки webhook: %s", e)
     else:
-        print("⚠️ WEB_URL не настроен, webhook не установлен")
+        logger.warning("WEB_URL не настроен, webhook не установлен")
     
     yield
     
     # Shutdown
     try:
-        await telegram_bot.bot.delete_webhook()
-        print("✅ Telegram webhook удален")
+        if notifications_enabled():
+            await get_bot().delete_webhook()
+            logger.info("Telegram webhook удален")
     except:
         pass
-    print("👋 Сервер остановлен")
+    await notification_outbox.stop_outbox()
+    await close_telegram_bot()
+    await maintenance.stop_retention_job()
+    await device_state.stop_device_state()
+    await ingest_writer.stop_writer()
+    close_pool()
+    logger.info("Сервер остановлен")
+    stop_logging()
 
 
 # Инициализация FastAPI приложения
@@ -75,12 +136,268 @@ app = FastAPI(
     title="Device Manager API",
     description="API для управления Android устройствами",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # orjson: быстрая сериализация ответов (списки устройств, история SMS)
+    default_response_class=ORJSONResponse
 )
 
 
+class PreparedEvent(NamedTuple):
+    """Событие, готовое к записи: операции для писателя"""
+    device_id: str
+    event_type: str
+    timestamp: str
+    operations: List[Tuple]
+    # SMS с заданием на уведомление в notification_outbox - после фиксации будим обработчик
+    notify: bool
+    # Ключ идемпотентности (app/idempotency.py)
+    dedup_key: bytes
+    # Состояние устройства для отложенной записи в каталог (app/device_state.py) или None
+    device_update: Optional[dict] = None
+
+
+def validation_detail(error: ValidationError) -> str:
+    """Краткое описание ошибок валидации события"""
+    parts = []
+    for item in error.errors():
+        location = item['loc']
+        # Первый элемент пути у известных типов - тег модели (sms, ...), клиенту он не нужен
+        if location and location[0] in EVENT_MODELS:
+            location = location[1:]
+        parts.append(f"{'.'.join(str(part) for part in location) or 'event'}: {item['msg']}")
+    return "Неверный формат события: " + "; ".join(parts)
+
+
+def parse_event(data: Union[bytes, str, Any]) -> BaseEvent:
+    """
+    Разобрать событие: JSON (bytes/str) или уже разобранный объект.
+    При ошибке формата бросает HTTPException 400
+    """
+    try:
+        return parse_event_model(data)
+    except ValidationError as e:
+        detail = validation_detail(e)
+        logger.warning(detail)
+        raise HTTPException(status_code=400, detail=detail)
+
+
+# ===== Обработчики типов событий =====
+# Возвращают операции записи (кроме сохранения в журнал events), признак уведомления о SMS
+# и обновление устройства: (данные для update_device_tx, имя при создании) или None
+
+def handle_device_status(event: DeviceStatusEvent, device_id: str):
+    # Имя из события используется ТОЛЬКО при создании устройства (UPSERT)
+    # Для существующих устройств имя НЕ обновляется (можно менять только вручную через API)
+    default_name = event.device.name or f'Device {device_id}'
+    update_data = event.device.status_update(event.timestamp)
+    return [], False, (update_data, default_name)
+
+
+def handle_sms(event: SMSEvent, device_id: str):
+    # Задание на уведомление в Telegram записывается в одной транзакции с SMS
+    notify = notification_outbox.enabled()
+    operations = [(save_sms_tx, (device_id, event.timestamp, event.sender, event.message, notify))]
+    # Обновляем данные устройства (без имени, чтобы не перезаписать пользовательское)
+    return operations, notify, (event.device.status_update(event.timestamp), None)
+
+
+def handle_boot_completed(event: BootCompletedEvent, device_id: str):
+    # Обновляем информацию об устройстве после перезагрузки (как device_status)
+    return handle_device_status(event, device_id)
+
+
+EVENT_HANDLERS = {
+    DeviceStatusEvent: handle_device_status,
+    SMSEvent: handle_sms,
+    BootCompletedEvent: handle_boot_completed,
+}
+
+
+def log_event(event: BaseEvent, device_id: str):
+    """
+    Запись о принятом событии. device_status приходят часто, поэтому по каждому
+    устройству пишется не больше одной записи за LOG_DEVICE_STATUS_INTERVAL.
+    Текст SMS передается в поле sms_text и скрывается форматтером журнала
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if isinstance(event, DeviceStatusEvent):
+        skipped = device_status_sampler.sample(device_id)
+        if skipped is not None:
+            logger.info(
+                "Получено событие",
+                extra={'event_type': event.type, 'device_id': device_id, 'skipped': skipped}
+            )
+    elif isinstance(event, SMSEvent):
+        logger.info(
+            "Получено событие",
+            extra={'event_type': event.type, 'device_id': device_id,
+                   'sender': event.sender, SMS_TEXT_FIELD: event.message}
+        )
+    else:
+        logger.info("Получено событие", extra={'event_type': event.type, 'device_id': device_id})
+
+
+async def prepare_event(event: BaseEvent) -> PreparedEvent:
+    """
+    Собрать операции записи для разобранного события.
+    Если устройство определить нельзя, бросает HTTPException (400 или 409)
+    """
+    # ID устройства - во вложенном блоке device или (старый формат) в корне
+    device_id = event.device.id or event.device_id
+    device_name = event.device.name
+    
+    # Для SMS событий может не быть ID в device, но имя должно быть
+    # Используем имя устройства для поиска существующего ID
+    if not device_id and isinstance(event, SMSEvent) and device_name:
+        # Ищем устройство по имени
+        metrics.increment('device_name_lookups')
+        try:
+            device_id = await find_device_id_by_name_async(device_name)
+        except AmbiguousDeviceName as e:
+            metrics.increment('device_name_lookups_ambiguous')
+            logger.warning(str(e), extra={'event_type': event.type})
+            raise HTTPException(
+                status_code=409,
+                detail=f"{e}. Передайте device.id в событии"
+            )
+        if device_id:
+            metrics.increment('device_name_lookups_resolved')
+            logger.debug("Найден device_id по имени", extra={'device_id': device_id, 'device_name': device_name})
+        else:
+            metrics.increment('device_name_lookups_not_found')
+    
+    if not device_id:
+        logger.warning(
+            "Отсутствует device_id",
+            extra={'event_type': event.type, 'device_name': device_name}
+        )
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Отсутствует device.id для события {event.type}. Убедитесь, что устройство было зарегистрировано через device_status"
+        )
+    
+    log_event(event, device_id)
+    
+    # Все записи события (events, sms_logs) собираются в один запрос к писателю
+    # и фиксируются одной транзакцией в шарде устройства
+    payload = event.payload()
+    dedup_key = event_key(device_id, payload, event.event_id)
+    operations = [(save_event_tx, (device_id, event.type, event.timestamp, payload, dedup_key))]
+    notify = False
+    deferred_update = None
+    
+    handler = EVENT_HANDLERS.get(type(event))
+    if handler is not None:
+        handler_operations, notify, device_update = handler(event, device_id)
+        operations.extend(handler_operations)
+        if device_update is not None:
+            update_data, default_name = device_update
+            if device_state.defer(device_id):
+                # При шардировании состояние известного устройства пишется в каталог пакетом после фиксации
+                deferred_update = update_data
+            else:
+                # В транзакции события: без шардирования и для нового устройства
+                operations.append((update_device_tx, (device_id, update_data, default_name)))
+    
+    return PreparedEvent(device_id, event.type, event.timestamp, operations, notify, dedup_key, deferred_update)
+
+
+def seen_recently(prepared: PreparedEvent) -> bool:
+    """Повтор уже сохраненного события (по кэшу ключей, без обращения к базе)"""
+    metrics.increment('events_received')
+    if prepared.dedup_key in recent_events:
+        metrics.increment('events_duplicate')
+        log_duplicate(prepared)
+        return True
+    return False
+
+
+def stored_duplicate(prepared: PreparedEvent):
+    """Повтор, распознанный уникальным индексом при записи (операции запроса откатаны)"""
+    metrics.increment('events_duplicate')
+    metrics.increment('events_duplicate_stored')
+    recent_events.add(prepared.dedup_key)
+    log_duplicate(prepared)
+
+
+def committed(prepared: PreparedEvent):
+    """Действия после фиксации события: кэш ключей, состояние устройства, уведомление"""
+    recent_events.add(prepared.dedup_key)
+    if prepared.device_update is not None:
+        device_state.record(prepared.device_id, prepared.device_update)
+    if prepared.notify:
+        notification_outbox.wake(prepared.device_id)
+
+
+def log_duplicate(prepared: PreparedEvent):
+    logger.info(
+        "Повтор события, запись пропущена",
+        extra={'event_type': prepared.event_type, 'device_id': prepared.device_id}
+    )
+
+
+def duplicate_result(prepared: PreparedEvent) -> Dict[str, Any]:
+    return {
+        "status": "success",
+        "message": f"Событие {prepared.event_type} уже было обработано",
+        "device_id": prepared.device_id,
+        "type": prepared.event_type,
+        "duplicate": True
+    }
+
+
+def admit(device_id: Optional[str] = None):
+    """
+    Занять место в лимитах приема (app/admission.py), после обработки - admission.release().
+    Сверх лимита бросает HTTPException 429 с Retry-After
+    """
+    try:
+        admission.acquire(device_id)
+    except Rejected as e:
+        raise rejected(e, device_id)
+
+
+def charge_device(device_id: str):
+    """Списать токен устройства за событие пакета POST /events. Сверх лимита - HTTPException 429"""
+    try:
+        admission.charge(device_id)
+    except Rejected as e:
+        raise rejected(e, device_id)
+
+
+def rejected(error: Rejected, device_id: Optional[str]) -> HTTPException:
+    metrics.increment('admission_rejected')
+    logger.debug(error.reason, extra={'device_id': device_id})
+    return HTTPException(status_code=429, detail=error.reason, headers={"Retry-After": error.retry_after_header})
+
+
+async def store_event(prepared: PreparedEvent) -> ORJSONResponse:
+    """Записать событие (повтор только подтверждается); уведомление о SMS отправит outbox"""
+    if seen_recently(prepared):
+        return ORJSONResponse(status_code=200, content=duplicate_result(prepared))
+    
+    # Ждем фиксации транзакции, чтобы ответ подтверждал сохранение
+    try:
+        await ingest_writer.submit(prepared.operations)
+    except DuplicateEvent:
+        stored_duplicate(prepared)
+        return ORJSONResponse(status_code=200, content=duplicate_result(prepared))
+    committed(prepared)
+    
+    return ORJSONResponse(
+        status_code=200,
+        content={
+            "status": "success",
+            "message": f"Событие {prepared.event_type} успешно обработано",
+            "device_id": prepared.device_id,
+            "type": prepared.event_type
+        }
+    )
+
+
 @app.post("/event")
-async def receive_event(event: Dict[str, Any]):
+async def receive_event(request: Request):
     """
     Принимает события от Android-устройств
     
@@ -88,217 +405,205 @@ async def receive_event(event: Dict[str, Any]):
     - device_status: обновление статуса устройства
     - sms: новое SMS сообщение
     - boot_completed: уведомление о перезагрузке
+    
+    Тело запроса разбирается сразу в модель события (app/models.py).
+    Повтор уже сохраненного события (event_id или то же содержимое)
+    подтверждается с duplicate=true без записи и уведомления.
+    Сверх лимита устройства или сервера - 429 с Retry-After
     """
     try:
-        print(f"\n📥 Получено событие: {event.get('type', 'unknown')}")
-        
-        # Получаем тип события
-        event_type = event.get('type')
-        timestamp = event.get('timestamp')
+        prepared = await prepare_event(parse_event(await request.body()))
+        admit(prepared.device_id)
+        try:
+            return await store_event(prepared)
+        finally:
+            admission.release()
         
-        if not event_type or not timestamp:
-            print(f"❌ Отсутствуют обязательные поля. Event: {event}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("КРИТИЧЕСКАЯ ОШИБКА при обработке события")
+        raise HTTPException(status_code=500, detail=f"Ошибка обработки события: {str(e)}")
+
+
+# Максимальное число событий в одном запросе POST /events
+EVENTS_BATCH_MAX = int(os.getenv('EVENTS_BATCH_MAX', '1000'))
+
+
+def parse_events_body(body: bytes) -> List[Any]:
+    """
+    Разобрать тело POST /events: JSON-массив событий или NDJSON (одно событие в строке).
+    Для NDJSON возвращаются строки - каждая разбирается при проверке своего события,
+    поэтому неверная строка дает ошибку только своего элемента
+    """
+    body = body.strip()
+    if body.startswith(b'['):
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Неверный JSON: {e}")
+    return [line for line in (line.strip() for line in body.splitlines()) if line]
+
+
+@app.post("/events")
+async def receive_events(request: Request):
+    """
+    Пакетная загрузка событий (накопленных устройством без связи).
+    
+    Тело - JSON-массив событий или NDJSON (application/x-ndjson).
+    Все события записываются одной транзакцией, ошибка одного события
+    не отменяет остальные. Уведомления о SMS ставятся в очередь и отправляются
+    по порядку времени событий.
+    Повторы уже сохраненных событий подтверждаются с duplicate=true без записи.
+    Пакет занимает одно место в общем пределе запросов (429 с Retry-After сверх него),
+    токен лимита устройства списывается за каждое событие (сверх лимита - ошибка события 429)
+    """
+    admit()
+    try:
+        return await store_events(request)
+    finally:
+        admission.release()
+
+
+async def store_events(request: Request) -> ORJSONResponse:
+    """Разобрать и записать пакет событий POST /events"""
+    try:
+        events = parse_events_body(await request.body())
+        if len(events) > EVENTS_BATCH_MAX:
             raise HTTPException(
-                status_code=400, 
-                detail="Отсутствуют обязательные поля: type, timestamp"
+                status_code=413,
+                detail=f"Слишком много событий в запросе (максимум {EVENTS_BATCH_MAX})"
             )
         
-        # Для SMS выводим дополнительную информацию
-        if event_type == "sms":
-            print(f"   📨 SMS данные: from={event.get('from')}, message_length={len(event.get('message', ''))}")
-        
-        # Извлекаем данные устройства из вложенной структуры
-        device_data = event.get('device', {})
-        device_id = device_data.get('id')
-        device_name = device_data.get('name')
-        battery = device_data.get('battery', 0)
-        
-        # Если ID нет в device, пытаемся найти в корне
-        if not device_id:
-            device_id = event.get('device_id')
-        
-        # Для SMS событий может не быть ID в device, но имя должно быть
-        # Используем имя устройства для поиска существующего ID
-        if not device_id and event_type == "sms" and device_name:
-            # Ищем устройство по имени
-            from app.database import get_connection
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM devices WHERE name = ? LIMIT 1", (device_name,))
-            row = cursor.fetchone()
-            if row:
-                device_id = row['id']
-                print(f"   Найден device_id по имени: {device_id}")
-            conn.close()
+        logger.info("Получен пакет событий", extra={'events': len(events)})
         
-        if not device_id:
-            print(f"❌ Отсутствует device_id. Device data: {device_data}, event_type: {event_type}")
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Отсутствует device.id для события {event_type}. Убедитесь, что устройство было зарегистрировано через device_status"
-            )
-        
-        print(f"   Device ID: {device_id}, Type: {event_type}")
+        results: List[Dict[str, Any]] = [None] * len(events)
+        prepared_items: List[Tuple[int, PreparedEvent]] = []
+        for index, event in enumerate(events):
+            try:
+                prepared = await prepare_event(parse_event(event))
+                charge_device(prepared.device_id)
+                if seen_recently(prepared):
+                    results[index] = {"index": index, **duplicate_result(prepared)}
+                    continue
+                prepared_items.append((index, prepared))
+            except HTTPException as e:
+                results[index] = {"index": index, "status": "error", "code": e.status_code, "detail": e.detail}
+                if e.headers and "Retry-After" in e.headers:
+                    results[index]["retry_after"] = int(e.headers["Retry-After"])
+            except Exception as e:
+                logger.exception("Ошибка обработки события пакета", extra={'index': index})
+                results[index] = {"index": index, "status": "error", "code": 500, "detail": str(e)}
         
-        # Сохраняем событие в таблицу events
-        save_event(device_id, event_type, timestamp, event)
+        # Одна транзакция на пакет, каждое событие - в своей точке сохранения
+        outcomes = await ingest_writer.submit_many([prepared.operations for _, prepared in prepared_items])
         
-        # Обрабатываем событие в зависимости от типа
-        if event_type == "device_status":
-            # Извлекаем данные о сети из device (новый формат)
-            signal_strength_raw = device_data.get('signalStrength', 0)
-            signal_strength = int((signal_strength_raw / 4) * 100) if signal_strength_raw else 0
-            
-            # Получаем тип сети
-            network_type = device_data.get('networkType', 'Unknown')
-            
-            # Получаем тип интернета
-            internet_connected = device_data.get('internetConnected', False)
-            connection_type = device_data.get('connectionType', 'Unknown')
-            internet_type = f"{connection_type}" if internet_connected else 'Disconnected'
-            
-            # Проверяем, есть ли уже устройство в базе
-            existing_device = get_device_by_id(device_id)
-            
-            # Обновляем информацию об устройстве
-            update_data = {
-                'battery': battery,
-                'signal_strength': signal_strength,
-                'network_type': network_type,
-                'internet': internet_type,
-                'timestamp': timestamp
-            }
-            
-            # Имя добавляем ТОЛЬКО если устройства еще нет в базе
-            # Для существующих устройств имя НЕ обновляется (можно менять только вручную через API)
-            if not existing_device:
-                # Новое устройство - используем имя из события
-                update_data['name'] = device_name if device_name else f'Device {device_id}'
-            # Для существующих устройств НЕ добавляем 'name' - имя сохраняется
-            
-            update_device(device_id, update_data)
-            
-        elif event_type == "sms":
-            try:
-                # Сохраняем SMS
-                sender = event.get('from', 'Unknown')
-                message = event.get('message', '')
-                print(f"   📨 SMS от {sender}: {message[:50]}...")
-                save_sms(device_id, timestamp, sender, message)
-                
-                # Отправляем уведомление в Telegram
-                try:
-                    await send_sms_notification_async(device_id, sender, message, timestamp)
-                except Exception as e:
-                    print(f"   ⚠️ Ошибка отправки в Telegram: {e}")
-                    import traceback
-                    traceback.print_exc()
-                
-                # Обновляем информацию об устройстве из SMS события
-                has_signal = device_data.get('hasSignal', False)
-                signal_strength_raw = device_data.get('signalStrength', 0)
-                signal_strength = int((signal_strength_raw / 4) * 100) if signal_strength_raw else 0
-                network_type = device_data.get('networkType', 'Unknown')
-                internet_connected = device_data.get('internetConnected', False)
-                connection_type = device_data.get('connectionType', 'Unknown')
-                
-                # Определяем тип интернета как в device_status
-                internet_type = f"{connection_type}" if internet_connected else 'Disconnected'
-                
-                # Обновляем данные устройства (без имени, чтобы не перезаписать пользовательское)
-                update_device(device_id, {
-                    'battery': battery,
-                    'signal_strength': signal_strength,
-                    'network_type': network_type,
-                    'internet': internet_type,
-                    'timestamp': timestamp
-                })
-            except Exception as sms_error:
-                print(f"❌ Ошибка обработки SMS: {sms_error}")
-                import traceback
-                traceback.print_exc()
-                raise HTTPException(status_code=500, detail=f"Ошибка обработки SMS: {str(sms_error)}")
-            
-        elif event_type == "boot_completed":
-            # Извлекаем данные о сети из device (новый формат)
-            signal_strength_raw = device_data.get('signalStrength', 0)
-            signal_strength = int((signal_strength_raw / 4) * 100) if signal_strength_raw else 0
-            network_type = device_data.get('networkType', 'Unknown')
-            
-            internet_connected = device_data.get('internetConnected', False)
-            connection_type = device_data.get('connectionType', 'Unknown')
-            internet_type = f"{connection_type}" if internet_connected else 'Disconnected'
-            
-            # Проверяем, есть ли уже устройство в базе
-            existing_device = get_device_by_id(device_id)
-            
-            # Обновляем информацию об устройстве после перезагрузки
-            update_data = {
-                'battery': battery,
-                'signal_strength': signal_strength,
-                'network_type': network_type,
-                'internet': internet_type,
-                'timestamp': timestamp
+        for (index, prepared), (_, error) in zip(prepared_items, outcomes):
+            if isinstance(error, DuplicateEvent):
+                stored_duplicate(prepared)
+                results[index] = {"index": index, **duplicate_result(prepared)}
+                continue
+            if error is not None:
+                logger.error(
+                    "Ошибка записи события пакета: %s", error,
+                    extra={'index': index, 'device_id': prepared.device_id}
+                )
+                results[index] = {"index": index, "status": "error", "code": 500, "detail": str(error)}
+                continue
+            committed(prepared)
+            results[index] = {
+                "index": index,
+                "status": "success",
+                "device_id": prepared.device_id,
+                "type": prepared.event_type
             }
-            
-            # Имя добавляем ТОЛЬКО если устройства еще нет в базе
-            # Для существующих устройств имя НЕ обновляется (можно менять только вручную через API)
-            if not existing_device:
-                # Новое устройство - используем имя из события
-                update_data['name'] = device_name if device_name else f'Device {device_id}'
-            # Для существующих устройств НЕ добавляем 'name' - имя сохраняется
-            
-            update_device(device_id, update_data)
         
-        return JSONResponse(
+        accepted = sum(1 for result in results if result["status"] == "success")
+        return ORJSONResponse(
             status_code=200,
             content={
                 "status": "success",
-                "message": f"Событие {event_type} успешно обработано",
-                "device_id": device_id,
-                "type": event_type
+                "accepted": accepted,
+                "rejected": len(results) - accepted,
+                "duplicates": sum(1 for result in results if result.get("duplicate")),
+                "results": results
             }
         )
         
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        error_traceback = traceback.format_exc()
-        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА при обработке события:")
-        print(error_traceback)
-        raise HTTPException(status_code=500, detail=f"Ошибка обработки события: {str(e)}")
+        logger.exception("КРИТИЧЕСКАЯ ОШИБКА при обработке пакета событий")
+        raise HTTPException(status_code=500, detail=f"Ошибка обработки пакета событий: {str(e)}")
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """
+    Ответ 304, если клиент прислал актуальный ETag в If-None-Match.
+    Опрашивающие страницы в этом случае не скачивают данные повторно
+    """
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+
+def json_with_etag(content: dict, etag: str) -> ORJSONResponse:
+    """JSON-ответ с ETag; no-cache - браузер перепроверяет ответ при каждом запросе"""
+    return ORJSONResponse(
+        status_code=200,
+        content=content,
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
 
 
 @app.get("/devices")
-async def list_devices():
+async def list_devices(request: Request, since: Optional[int] = Query(None, ge=0)):
     """
     Получить список всех устройств
+    
+    - since: версия из предыдущего ответа; вернутся только устройства,
+      измененные после нее, и список ID устройств онлайн (online_ids)
+    Поддерживается условный запрос (ETag / If-None-Match -> 304)
     """
     try:
-        devices = get_all_devices()
-        return JSONResponse(
-            status_code=200,
-            content={
+        current = await get_devices_version_async()
+        etag = f'W/"devices-{current["version"]}-{current["online_count"]}"'
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        
+        if since is not None:
+            changes = await get_devices_changes_async(since)
+            return json_with_etag({
                 "status": "success",
-                "count": len(devices),
-                "devices": devices
-            }
-        )
+                "version": changes['version'],
+                "count": len(changes['devices']),
+                "devices": changes['devices'],
+                "online_ids": changes['online_ids']
+            }, etag)
+        
+        devices = await get_all_devices_async()
+        return json_with_etag({
+            "status": "success",
+            "version": current['version'],
+            "count": len(devices),
+            "devices": devices
+        }, etag)
     except Exception as e:
-        import traceback
-        print(f"❌ Ошибка в /devices: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Ошибка в /devices")
         raise HTTPException(status_code=500, detail=f"Ошибка получения списка устройств: {str(e)}")
 
 
 @app.get("/device/{device_id}")
-async def get_device(device_id: str):
+async def get_device(device_id: str, request: Request):
     """
     Получить информацию о конкретном устройстве
+    
+    Поддерживается условный запрос (ETag / If-None-Match -> 304)
     """
     try:
-        device = get_device_by_id(device_id)
+        device = await get_device_by_id_async(device_id)
         
         if not device:
             raise HTTPException(
@@ -306,13 +611,15 @@ async def get_device(device_id: str):
                 detail=f"Устройство с ID {device_id} не найдено"
             )
         
-        return JSONResponse(
-            status_code=200,
-            content={
-                "status": "success",
-                "device": device
-            }
-        )
+        etag = f'W/"device-{device["row_version"]}-{int(device["online"])}"'
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        
+        return json_with_etag({
+            "status": "success",
+            "device": device
+        }, etag)
     except HTTPException:
         raise
     except Exception as e:
@@ -320,34 +627,125 @@ async def get_device(device_id: str):
 
 
 @app.get("/device/{device_id}/sms")
-async def get_device_sms_logs(device_id: str):
+async def get_device_sms_logs(
+    device_id: str,
+    request: Request,
+    limit: int = Query(SMS_PAGE_SIZE, ge=1, le=SMS_PAGE_SIZE_MAX),
+    before_id: Optional[int] = Query(None),
+    after_id: Optional[int] = Query(None),
+    since: Optional[int] = Query(None),
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = Query(None)
+):
     """
-    Получить список всех SMS для конкретного устройства
+    Получить страницу SMS для конкретного устройства (новые сверху)
+    
+    - limit: размер страницы
+    - before_id: более старые SMS, чем указанный id (следующая страница истории)
+    - after_id: более новые SMS, чем указанный id (новые поступления)
+    - since: то же, что after_id (версия истории SMS - id последней полученной SMS)
+    - from/to: ограничение периода (форматы "15.10.2025 14:30:00" или ISO)
+    
+    next_cursor в ответе передается в тот же параметр для следующей страницы,
+    null - страниц больше нет. Поддерживается условный запрос (ETag / If-None-Match -> 304)
     """
     try:
+        from_ts = parse_timestamp(from_) if from_ else None
+        to_ts = parse_timestamp(to) if to else None
+        if (from_ and from_ts is None) or (to and to_ts is None):
+            raise HTTPException(
+                status_code=400,
+                detail="Неверный формат времени в параметрах from/to"
+            )
+        
         # Проверяем существование устройства
-        device = get_device_by_id(device_id)
+        device = await get_device_by_id_async(device_id)
         if not device:
             raise HTTPException(
                 status_code=404, 
                 detail=f"Устройство с ID {device_id} не найдено"
             )
         
-        sms_list = get_device_sms(device_id)
+        if after_id is None:
+            after_id = since
+        
+        # Записи SMS не изменяются, поэтому любая страница меняется только с приходом новых SMS
+        etag = f'W/"sms-{await get_device_sms_version_async(device_id)}"'
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        
+        page = await get_device_sms_async(
+            device_id,
+            limit=limit,
+            before_id=before_id,
+            after_id=after_id,
+            from_ts=from_ts,
+            to_ts=to_ts
+        )
+        
+        return json_with_etag({
+            "status": "success",
+            "device_id": device_id,
+            "count": len(page['sms']),
+            "sms": page['sms'],
+            "next_cursor": page['next_cursor']
+        }, etag)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения SMS: {str(e)}")
+
+
+@app.get("/sms/search")
+async def search_sms_logs(
+    q: str = Query(..., min_length=1, max_length=200),
+    device_id: Optional[str] = Query(None),
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = Query(None),
+    limit: int = Query(SMS_SEARCH_PAGE_SIZE, ge=1, le=SMS_SEARCH_PAGE_SIZE_MAX),
+    offset: int = Query(0, ge=0)
+):
+    """
+    Полнотекстовый поиск SMS по всем устройствам
+    
+    - q: слова для поиска в тексте и отправителе (поиск по началу слова)
+    - device_id: только SMS указанного устройства
+    - from/to: ограничение периода (форматы "15.10.2025 14:30:00" или ISO)
+    - limit/offset: страница результатов; next_offset - смещение следующей страницы
+    """
+    try:
+        from_ts = parse_timestamp(from_) if from_ else None
+        to_ts = parse_timestamp(to) if to else None
+        if (from_ and from_ts is None) or (to and to_ts is None):
+            raise HTTPException(
+                status_code=400,
+                detail="Неверный формат времени в параметрах from/to"
+            )
+        
+        page = await search_sms_async(
+            q,
+            device_id=device_id,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            limit=limit,
+            offset=offset
+        )
         
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=200,
             content={
                 "status": "success",
-                "device_id": device_id,
-                "count": len(sms_list),
-                "sms": sms_list
+                "query": q,
+                "count": len(page['results']),
+                "results": page['results'],
+                "next_offset": page['next_offset']
             }
         )
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка получения SMS: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка поиска SMS: {str(e)}")
 
 
 @app.put("/device/{device_id}/name")
@@ -357,7 +755,7 @@ async def update_device_name(device_id: str, request: Request):
     """
     try:
         # Проверяем существование устройства
-        device = get_device_by_id(device_id)
+        device = await get_device_by_id_async(device_id)
         if not device:
             raise HTTPException(
                 status_code=404, 
@@ -381,9 +779,9 @@ async def update_device_name(device_id: str, request: Request):
             )
         
         # Обновляем имя в базе данных
-        update_device(device_id, {'name': new_name})
+        await ingest_writer.submit([(update_device_tx, (device_id, {'name': new_name}))])
         
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=200,
             content={
                 "status": "success",
@@ -398,6 +796,47 @@ async def update_device_name(device_id: str, request: Request):
         raise HTTPException(status_code=500, detail=f"Ошибка обновления имени: {str(e)}")
 
 
+@app.get("/maintenance/retention")
+async def retention_report():
+    """
+    Отчет об очистке журнала событий: политика хранения, удаленные строки
+    и освобожденное место в файле базы
+    """
+    try:
+        job = maintenance.get_retention_job()
+        return ORJSONResponse(
+            status_code=200,
+            content={
+                "status": "success",
+                "retention": job.report() if job else None,
+                "storage": await get_storage_stats_async()
+            }
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения отчета: {str(e)}")
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Счетчики работы сервера с момента запуска процесса, доля повторов
+    среди принятых событий, состояние лимитов приема (отказы по устройствам)
+    и очередь уведомлений о SMS по статусам
+    """
+    counters = metrics.snapshot()
+    received = counters.get('events_received', 0)
+    return ORJSONResponse(
+        status_code=200,
+        content={
+            "status": "success",
+            "counters": counters,
+            "duplicate_rate": round(counters.get('events_duplicate', 0) / received, 4) if received else 0.0,
+            "admission": admission.snapshot(),
+            "outbox": await get_outbox_stats_async()
+        }
+    )
+
+
 @app.get("/")
 async def root():
     """
@@ -426,17 +865,19 @@ async def telegram_webhook(request: Request):
     Webhook для Telegram бота
     Принимает обновления от Telegram и обрабатывает их
     """
+    bot = get_bot()
+    if bot is None:
+        return ORJSONResponse({"ok": False, "error": "Telegram бот не инициализирован"}, status_code=503)
     try:
-        update_data = await request.json()
-        update = Update(**update_data)
+        update = Update.model_validate(orjson.loads(await request.body()), context={"bot": bot})
         
         # Обрабатываем обновление через диспетчер
-        await telegram_bot.dp.feed_update(telegram_bot.bot, update)
+        await telegram_bot.dp.feed_update(bot, update)
         
-        return JSONResponse({"ok": True})
+        return ORJSONResponse({"ok": True})
     except Exception as e:
-        print(f"❌ Ошибка обработки Telegram webhook: {e}")
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        logger.exception("Ошибка обработки Telegram webhook")
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 
 @app.get("/telegram/webhook/info")
@@ -444,9 +885,12 @@ async def webhook_info():
     """
     Получить информацию о webhook
     """
+    bot = get_bot()
+    if bot is None:
+        raise HTTPException(status_code=503, detail="Telegram бот не инициализирован")
     try:
-        info = await telegram_bot.bot.get_webhook_info()
-        return JSONResponse({
+        info = await bot.get_webhook_info()
+        return ORJSONResponse({
             "url": info.url,
             "has_custom_certificate": info.has_custom_certificate,
             "pending_update_count": info.pending_update_count,
@@ -0,0 +1,174 @@
+"""
+Фоновое обслуживание базы данных: срок хранения журнала событий и инкрементальный VACUUM
+
+Политика задается в EVENT_RETENTION, например:
+    EVENT_RETENTION=device_status=7d,boot_completed=30d
+Типы, которых нет в политике (например, sms), хранятся бессрочно.
+События с неразобранным временем удаляются вместе с устаревшими событиями того же типа,
+записанными после них.
+
+Удаление идет небольшими порциями через писателя каждого шарда (app/ingest_writer.py),
+с паузой между порциями, поэтому запись входящих событий не простаивает.
+"""
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Dict, Optional
+
+from app.database import (
+    delete_expired_events_tx, get_expired_events_boundary_async, incremental_vacuum_tx, layout
+)
+from app import ingest_writer
+
+logger = logging.getLogger(__name__)
+
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_retention_policy(value: str) -> Dict[str, int]:
+    """
+    Разобрать политику вида "device_status=7d,boot_completed=12h".
+    Возвращает {тип события: срок хранения в секундах}
+    """
+    policy = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        event_type, _, duration = item.partition('=')
+        match = re.fullmatch(r'(\d+)\s*([smhdw]?)', duration.strip())
+        if not event_type.strip() or not match:
+            raise ValueError(f"Неверный элемент EVENT_RETENTION: {item!r}")
+        amount, unit = match.groups()
+        policy[event_type.strip()] = int(amount) * _DURATION_UNITS[unit or 'd']
+    return policy
+
+
+class RetentionJob:
+    """Периодическое удаление устаревших событий с последующим инкрементальным VACUUM"""
+
+    def __init__(self, policy: Dict[str, int], interval: float, chunk_size: int,
+                 chunk_pause: float, vacuum_pages: int):
+        self.policy = policy
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.chunk_pause = chunk_pause
+        self.vacuum_pages = vacuum_pages
+        self._task: Optional[asyncio.Task] = None
+
+        # Статистика для /maintenance/retention
+        self.running = False
+        self.runs = 0
+        self.last_run_at: Optional[str] = None
+        self.last_run_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.deleted_rows: Dict[str, int] = {event_type: 0 for event_type in policy}
+        self.bytes_reclaimed = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop(), name='retention-job')
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning("Ошибка очистки журнала событий: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """Один проход: удалить устаревшие события по всем типам и освободить место"""
+        self.running = True
+        started = datetime.now()
+        try:
+            now_ts = int(started.timestamp())
+            for database in layout.shards:
+                for event_type, max_age in self.policy.items():
+                    cutoff_ts = now_ts - max_age
+                    untimed_max_id = await get_expired_events_boundary_async(database, event_type, cutoff_ts)
+                    while True:
+                        results = await ingest_writer.submit([
+                            (delete_expired_events_tx, (event_type, cutoff_ts, self.chunk_size, untimed_max_id))
+                        ], database=database)
+                        deleted = results[0]
+                        self.deleted_rows[event_type] += deleted
+                        if deleted < self.chunk_size:
+                            break
+                        await asyncio.sleep(self.chunk_pause)
+
+            # Возвращаем освободившиеся страницы файловой системе тоже порциями
+            for database in layout.files:
+                while True:
+                    results = await ingest_writer.submit(
+                        [(incremental_vacuum_tx, (self.vacuum_pages,))], database=database
+                    )
+                    reclaimed = results[0]
+                    self.bytes_reclaimed += reclaimed
+                    if reclaimed <= 0:
+                        break
+                    await asyncio.sleep(self.chunk_pause)
+
+            self.last_error = None
+        finally:
+            self.running = False
+            self.runs += 1
+            self.last_run_at = started.isoformat()
+            self.last_run_seconds = (datetime.now() - started).total_seconds()
+
+    def report(self) -> Dict:
+        return {
+            "policy_seconds": self.policy,
+            "interval_seconds": self.interval,
+            "running": self.running,
+            "runs": self.runs,
+            "last_run_at": self.last_run_at,
+            "last_run_seconds": self.last_run_seconds,
+            "last_error": self.last_error,
+            "deleted_rows": dict(self.deleted_rows),
+            "deleted_rows_total": sum(self.deleted_rows.values()),
+            "bytes_reclaimed": self.bytes_reclaimed
+        }
+
+
+_job: Optional[RetentionJob] = None
+
+
+def start_retention_job() -> Optional[RetentionJob]:
+    """Запустить фоновую очистку (вызывается при старте приложения)"""
+    global _job
+    policy = parse_retention_policy(os.getenv('EVENT_RETENTION', ''))
+    _job = RetentionJob(
+        policy,
+        interval=float(os.getenv('RETENTION_INTERVAL_SECONDS', '3600')),
+        chunk_size=int(os.getenv('RETENTION_CHUNK_SIZE', '500')),
+        chunk_pause=float(os.getenv('RETENTION_CHUNK_PAUSE_MS', '50')) / 1000,
+        vacuum_pages=int(os.getenv('RETENTION_VACUUM_PAGES', '256'))
+    )
+    if policy:
+        _job.start()
+        logger.info("Очистка журнала событий запущена", extra={'retention': os.getenv('EVENT_RETENTION')})
+    else:
+        logger.info("EVENT_RETENTION не задан, журнал событий хранится бессрочно")
+    return _job
+
+
+async def stop_retention_job():
+    """Остановить фоновую очистку (вызывается при остановке приложения)"""
+    if _job is not None:
+        await _job.stop()
+
+
+def get_retention_job() -> Optional[RetentionJob]:
+    return _job
@@ -0,0 +1,24 @@
+"""
+Счетчики работы сервера в памяти процесса
+
+Отдаются эндпоинтом GET /metrics в JSON. Значения накапливаются с момента
+запуска процесса и сбрасываются при перезапуске.
+"""
+import threading
+from typing import Dict
+
+
+_counters: Dict[str, int] = {}
+_lock = threading.Lock()
+
+
+def increment(name: str, value: int = 1):
+    """Увеличить счетчик name на value"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def snapshot() -> Dict[str, int]:
+    """Текущие значения всех счетчиков"""
+    with _lock:
+        return dict(sorted(_counters.items()))
@@ -1,42 +1,168 @@
 """
 Pydantic модели для валидации входящих данных
+
+Модели повторяют формат, который присылает Android-приложение:
+данные устройства во вложенном блоке device, отправитель SMS в поле from.
+Неизвестные поля сохраняются (extra='allow') и попадают в журнал событий.
+
+Разбор не строже прежнего (словарь и .get с значениями по умолчанию): явный null
+в поле с значением по умолчанию заменяется этим значением, числа принимаются
+там, где ожидается строка (например, числовой device.id), батарея и уровень
+сигнала могут быть дробными. Эти замены касаются только модели: в журнал
+событий попадает событие в том виде, как его прислало устройство (payload).
+
+Событие разбирается функцией parse_event одним скомпилированным валидатором:
+модель выбирается по полю type (дискриминатор), события других типов
+разбираются как GenericEvent.
 """
-from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Dict, Literal, Optional, Union
 
+import orjson
+from pydantic import (
+    BaseModel, ConfigDict, Field, PrivateAttr, TypeAdapter, ValidationError, ValidationInfo, field_validator
+)
+from typing_extensions import Annotated
 
-class DeviceStatusEvent(BaseModel):
-    """Модель события статуса устройства"""
-    device_id: str
+
+def _default_if_none(cls, value: Any, info: ValidationInfo) -> Any:
+    """null в поле заменяется значением по умолчанию этого поля"""
+    if value is None:
+        return cls.model_fields[info.field_name].get_default(call_default_factory=True)
+    return value
+
+
+class DeviceInfo(BaseModel):
+    """Блок device события: идентификатор, имя и состояние устройства"""
+    model_config = ConfigDict(extra='allow', populate_by_name=True, coerce_numbers_to_str=True)
+
+    id: Optional[str] = None
     name: Optional[str] = None
-    battery: int
-    signal_strength: int
-    network_type: str
-    internet: str
-    timestamp: str
-    type: str = "device_status"
+    battery: Union[int, float] = 0
+    has_signal: bool = Field(False, alias='hasSignal')
+    signal_strength: Union[int, float] = Field(0, alias='signalStrength')  # 0-4 деления
+    network_type: str = Field('Unknown', alias='networkType')
+    internet_connected: bool = Field(False, alias='internetConnected')
+    connection_type: str = Field('Unknown', alias='connectionType')
+
+    @field_validator(
+        'battery', 'has_signal', 'signal_strength', 'network_type', 'internet_connected', 'connection_type',
+        mode='before'
+    )
+    @classmethod
+    def _none_as_default(cls, value: Any, info: ValidationInfo) -> Any:
+        return _default_if_none(cls, value, info)
+
+    def status_update(self, timestamp: str) -> Dict[str, Any]:
+        """Данные для обновления записи устройства (update_device_tx)"""
+        return {
+            'battery': self.battery,
+            'signal_strength': int((self.signal_strength / 4) * 100) if self.signal_strength else 0,
+            'network_type': self.network_type,
+            'internet': self.connection_type if self.internet_connected else 'Disconnected',
+            'timestamp': timestamp
+        }
+
+
+class BaseEvent(BaseModel):
+    """Общие поля всех событий"""
+    model_config = ConfigDict(extra='allow', populate_by_name=True, coerce_numbers_to_str=True)
+
+    type: str
+    timestamp: str = Field(min_length=1)
+    device: DeviceInfo = Field(default_factory=DeviceInfo)
+    # Старый формат: ID устройства в корне события
+    device_id: Optional[str] = None
+    # Идентификатор события от клиента: повтор с тем же event_id не сохраняется (app/idempotency.py)
+    event_id: Optional[str] = Field(None, max_length=128)
+    # Событие, как его прислало устройство (компактный JSON); задается parse_event
+    _raw: Optional[bytes] = PrivateAttr(None)
 
+    @field_validator('device', mode='before')
+    @classmethod
+    def _none_as_default(cls, value: Any, info: ValidationInfo) -> Any:
+        return _default_if_none(cls, value, info)
 
-class SMSEvent(BaseModel):
+    def payload(self) -> bytes:
+        """
+        Событие в исходном виде (компактный JSON) для журнала events: значения полей
+        как прислало устройство, без замены null и приведения чисел к строкам
+        """
+        if self._raw is not None:
+            return self._raw
+        return self.model_dump_json(by_alias=True, exclude_unset=True).encode('utf-8')
+
+
+class DeviceStatusEvent(BaseEvent):
+    """Модель события статуса устройства"""
+    type: Literal['device_status']
+
+
+class SMSEvent(BaseEvent):
     """Модель события SMS"""
-    device_id: str
-    sender: str
-    message: str
-    timestamp: str
-    type: str = "sms"
+    type: Literal['sms']
+    sender: str = Field('Unknown', alias='from')
+    message: str = ''
+
+    @field_validator('sender', 'message', mode='before')
+    @classmethod
+    def _sms_none_as_default(cls, value: Any, info: ValidationInfo) -> Any:
+        return _default_if_none(cls, value, info)
 
 
-class BootCompletedEvent(BaseModel):
+class BootCompletedEvent(BaseEvent):
     """Модель события перезагрузки устройства"""
-    device_id: str
-    name: Optional[str] = None
-    timestamp: str
-    type: str = "boot_completed"
+    type: Literal['boot_completed']
 
 
-class GenericEvent(BaseModel):
+class GenericEvent(BaseEvent):
     """Общая модель для любого события"""
-    device_id: str
-    type: str
-    timestamp: str
+    type: str = Field(min_length=1)
+
+
+# Типы событий с отдельной моделью
+EVENT_MODELS = {
+    'device_status': DeviceStatusEvent,
+    'sms': SMSEvent,
+    'boot_completed': BootCompletedEvent,
+}
+
+# Валидаторы собираются один раз при импорте. Известные типы выбираются
+# дискриминатором по полю type, остальные разбираются как GenericEvent
+event_adapter: TypeAdapter = TypeAdapter(
+    Annotated[Union[DeviceStatusEvent, SMSEvent, BootCompletedEvent], Field(discriminator='type')]
+)
+generic_event_adapter: TypeAdapter = TypeAdapter(GenericEvent)
+
+
+def _is_unknown_type(error: ValidationError) -> bool:
+    errors = error.errors()
+    return len(errors) == 1 and errors[0]['type'] in ('union_tag_invalid', 'union_tag_not_found')
+
 
+def parse_event(data: Any) -> BaseEvent:
+    """
+    Разобрать событие из JSON (bytes/str) или из уже разобранного объекта.
+    При ошибке формата бросает pydantic.ValidationError
+    """
+    if isinstance(data, (bytes, str)):
+        try:
+            event = event_adapter.validate_json(data)
+        except ValidationError as e:
+            if not _is_unknown_type(e):
+                raise
+            event = generic_event_adapter.validate_json(data)
+        # Один и тот же компактный JSON для /event и элемента /events (ключ идемпотентности)
+        try:
+            event._raw = orjson.dumps(orjson.loads(data))
+        except orjson.JSONDecodeError:
+            # NaN/Infinity принимает pydantic, но не orjson - сохраняем как прислано
+            event._raw = data.encode('utf-8') if isinstance(data, str) else bytes(data).strip()
+        return event
+    try:
+        event = event_adapter.validate_python(data)
+    except ValidationError as e:
+        if not _is_unknown_type(e):
+            raise
+        event = generic_event_adapter.validate_python(data)
+    event._raw = orjson.dumps(data)
+    return event
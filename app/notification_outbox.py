@@ -0,0 +1,246 @@
+"""
+Очередь уведомлений о SMS (transactional outbox)
+
+Уведомление не отправляется из обработчика POST /event: вместе с SMS в той же
+транзакции (save_sms_tx, notify=True) в таблицу notification_outbox шарда
+записывается задание, и ответ устройству не ждет Telegram. Задания доставляют
+фоновые обработчики - по одному на файл-шард (app/storage.py):
+  - после записи SMS обработчик будится сразу (wake), а задания для повтора
+    забираются по времени next_attempt_ts не реже раза в OUTBOX_POLL_SECONDS;
+  - задания прохода ставятся в очереди чатов по порядку SMS и отправляются
+    в разные чаты параллельно с учетом лимитов Telegram (app/telegram_sender.py);
+    результат каждого задания записывается, как только завершена его отправка,
+    и обработчик не ждет медленных чатов, чтобы забрать следующие задания
+    (задания в отправке не забираются повторно);
+  - неудачная отправка повторяется с экспоненциальной задержкой
+    (OUTBOX_BACKOFF_SECONDS * 2^попытка, не больше OUTBOX_BACKOFF_MAX_SECONDS);
+    после OUTBOX_MAX_ATTEMPTS попыток задание получает статус failed;
+  - чаты, которым уже доставлено, запоминаются в done_chats и при повторе пропускаются;
+  - при старте обработчик сразу забирает все ожидающие задания, поэтому
+    уведомления, не отправленные до остановки процесса, не теряются.
+
+Доставка "хотя бы один раз": если процесс остановится во время отправки,
+чаты текущего задания могут получить уведомление повторно.
+Доставленные задания удаляются через OUTBOX_KEEP_HOURS.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Dict, Optional, Set
+
+from app.database import (
+    get_due_notifications_async,
+    update_notification_tx,
+    delete_delivered_notifications_tx,
+    layout
+)
+from app.telegram_notifications import queue_sms_notification, QueuedNotification
+from app import ingest_writer
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxWorker:
+    """Доставка уведомлений из notification_outbox одного файла базы"""
+
+    # Как часто удалять доставленные задания, с
+    CLEANUP_INTERVAL = 3600
+    # Сколько проходов (batch_size заданий) может одновременно ждать отправки
+    MAX_PENDING_BATCHES = 10
+
+    def __init__(self, database: str, batch_size: int, poll_interval: float, max_attempts: int,
+                 backoff: float, backoff_max: float, keep_seconds: float, name: str):
+        self.database = database
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.keep_seconds = keep_seconds
+        self.name = name
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_cleanup = 0.0
+        # Задания, поставленные в очереди чатов и еще не записанные, и задачи их завершения
+        self._in_flight: Set[int] = set()
+        self._finishing: Set[asyncio.Task] = set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop(), name=self.name)
+
+    async def stop(self):
+        # Незавершенное задание остается pending и будет отправлено после перезапуска
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in self._finishing:
+            task.cancel()
+        await asyncio.gather(*self._finishing, return_exceptions=True)
+        self._finishing.clear()
+        self._in_flight.clear()
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                processed = await self.run_once()
+                await self._cleanup()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка обработки очереди уведомлений", extra={'database': self.database})
+                processed = 0
+            if processed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self) -> int:
+        """
+        Поставить в отправку уведомления, которым пришло время (не дожидаясь отправки).
+        Возвращает число новых заданий
+        """
+        if len(self._in_flight) >= self.batch_size * self.MAX_PENDING_BATCHES:
+            return 0
+        # Задания в отправке остаются pending - пропускаем их
+        rows = await get_due_notifications_async(
+            self.database, time.time(), self.batch_size + len(self._in_flight)
+        )
+        rows = [row for row in rows if row['id'] not in self._in_flight][:self.batch_size]
+        # Задания ставятся в очереди чатов по порядку (порядок SMS в каждом чате сохраняется),
+        # а отправляются в разные чаты параллельно (app/telegram_sender.py).
+        # Результат каждого записывается сразу после его отправки
+        for row in rows:
+            queued = await self._queue(row)
+            self._in_flight.add(row['id'])
+            task = asyncio.create_task(self._finish_safe(row, queued))
+            self._finishing.add(task)
+            task.add_done_callback(self._finishing.discard)
+        return len(rows)
+
+    async def _finish_safe(self, row: Dict, queued):
+        try:
+            await self._finish(row, queued)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(
+                "Ошибка записи результата уведомления",
+                extra={'database': self.database, 'outbox_id': row['id']}
+            )
+        finally:
+            self._in_flight.discard(row['id'])
+
+    async def _queue(self, row: Dict):
+        """Поставить задание в очереди чатов. Возвращает QueuedNotification или исключение"""
+        if row['message'] is None:
+            # SMS удалено или перенесено в другой шард
+            return LookupError("SMS не найдено")
+        done_chats = json.loads(row['done_chats']) if row['done_chats'] else []
+        try:
+            return await queue_sms_notification(
+                row['device_id'], row['sender'], row['message'], row['timestamp'], skip_chats=done_chats
+            )
+        except Exception as e:
+            return e
+
+    async def _finish(self, row: Dict, queued):
+        done_chats = json.loads(row['done_chats']) if row['done_chats'] else []
+        attempts = row['attempts'] + 1
+        if isinstance(queued, QueuedNotification):
+            delivered, errors = await queued.result()
+            done_chats.extend(delivered)
+        else:
+            errors = [str(queued)]
+            if isinstance(queued, LookupError):
+                attempts = self.max_attempts
+
+        if not errors:
+            status, next_attempt_ts, last_error = 'delivered', time.time(), None
+            metrics.increment('notifications_delivered')
+        elif attempts >= self.max_attempts:
+            status, next_attempt_ts, last_error = 'failed', time.time(), "; ".join(errors)
+            metrics.increment('notifications_failed')
+            logger.error(
+                "Уведомление о SMS не доставлено: %s", last_error,
+                extra={'device_id': row['device_id'], 'sms_id': row['sms_id'], 'attempts': attempts}
+            )
+        else:
+            status, last_error = 'pending', "; ".join(errors)
+            next_attempt_ts = time.time() + self._retry_delay(attempts)
+            metrics.increment('notifications_retried')
+
+        await ingest_writer.submit([
+            (update_notification_tx, (row['id'], status, attempts, next_attempt_ts, done_chats, last_error))
+        ], database=self.database)
+
+    def _retry_delay(self, attempts: int) -> float:
+        """Экспоненциальная задержка с разбросом +-20%, чтобы повторы не совпадали"""
+        delay = min(self.backoff_max, self.backoff * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < self.CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        while True:
+            results = await ingest_writer.submit([
+                (delete_delivered_notifications_tx, (now - self.keep_seconds, 500))
+            ], database=self.database)
+            if results[0] < 500:
+                break
+
+
+# Обработчики по файлам-шардам
+_workers: Dict[str, OutboxWorker] = {}
+
+
+def start_outbox():
+    """Запустить обработчики очереди уведомлений (вызывается при старте приложения)"""
+    for index, database in enumerate(layout.shards):
+        worker = OutboxWorker(
+            database,
+            batch_size=int(os.getenv('OUTBOX_BATCH_SIZE', '50')),
+            poll_interval=float(os.getenv('OUTBOX_POLL_SECONDS', '5')),
+            max_attempts=int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8')),
+            backoff=float(os.getenv('OUTBOX_BACKOFF_SECONDS', '2')),
+            backoff_max=float(os.getenv('OUTBOX_BACKOFF_MAX_SECONDS', '600')),
+            keep_seconds=float(os.getenv('OUTBOX_KEEP_HOURS', '24')) * 3600,
+            name=f'outbox-{index}'
+        )
+        worker.start()
+        _workers[database] = worker
+    logger.info("Обработчики очереди уведомлений запущены", extra={'workers': len(_workers)})
+
+
+async def stop_outbox():
+    """Остановить обработчики (вызывается при остановке приложения)"""
+    workers = list(_workers.values())
+    _workers.clear()
+    await asyncio.gather(*(worker.stop() for worker in workers))
+
+
+def enabled() -> bool:
+    """Запущены ли обработчики (задания в очередь ставятся только тогда)"""
+    return bool(_workers)
+
+
+def wake(device_id: str):
+    """Разбудить обработчик шарда устройства после записи SMS с уведомлением"""
+    worker = _workers.get(layout.shard_for(device_id))
+    if worker is not None:
+        worker.wake()
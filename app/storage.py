@@ -0,0 +1,44 @@
+"""
+Размещение данных по файлам SQLite
+
+Таблицы devices и device_chat_bindings хранятся в каталоге (DATABASE_PATH),
+а журналы events и sms_logs распределяются по DATABASE_SHARDS файлам-шардам
+по хешу device_id. У каждого файла своя блокировка записи, поэтому запись
+событий разных устройств идет параллельно. При шардировании состояние известных
+устройств пишется в каталог не в транзакции события, а пакетом (app/device_state.py),
+поэтому каталог не становится общей точкой сериализации приема.
+
+При DATABASE_SHARDS=1 (по умолчанию) шард совпадает с каталогом - все данные
+в одном файле, как раньше. После изменения числа шардов существующие события
+и SMS нужно перенести скриптом scripts/reshard_storage.py.
+
+Все файлы имеют одинаковую схему (одни и те же миграции), неиспользуемые
+таблицы в них просто пусты.
+"""
+import os
+import zlib
+from typing import List
+
+
+class StorageLayout:
+    """Пути к каталогу и шардам и выбор шарда для устройства"""
+
+    def __init__(self, catalog: str, shard_count: int):
+        self.catalog = catalog
+        self.shard_count = max(1, shard_count)
+        if self.shard_count == 1:
+            self.shards = [catalog]
+        else:
+            root, ext = os.path.splitext(catalog)
+            self.shards = [f"{root}.shard{i}{ext or '.db'}" for i in range(self.shard_count)]
+
+    @property
+    def files(self) -> List[str]:
+        """Все файлы базы без повторов: каталог, затем шарды"""
+        return list(dict.fromkeys([self.catalog] + self.shards))
+
+    def shard_for(self, device_id: str) -> str:
+        """Файл-шард с журналами устройства (crc32 стабилен между запусками и версиями Python)"""
+        if self.shard_count == 1:
+            return self.shards[0]
+        return self.shards[zlib.crc32(device_id.encode('utf-8')) % self.shard_count]
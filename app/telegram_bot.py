@@ -3,29 +3,29 @@ Telegram Bot для управления устройствами и получ
 Использует aiogram 3.x
 """
 import asyncio
+import logging
 import os
 import sys
 from datetime import datetime, timedelta
 from typing import List
 import pytz
 
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import Dispatcher, F, Router
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.enums import ParseMode
-from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 import aiohttp
 
 from app.database import (
-    init_database,
-    get_all_devices,
-    get_device_by_id,
-    add_device_binding,
-    remove_device_binding,
-    get_chat_bindings,
-    get_device_chats
+    init_database_async,
+    get_all_devices_async,
+    get_device_by_id_async,
+    add_device_binding_async,
+    remove_device_binding_async,
+    get_chat_bindings_async
 )
+from app.logging_setup import setup_logging, stop_logging
+from app.telegram_notifications import init_telegram_bot, close_telegram_bot, get_bot
 
 # Загружаем переменные окружения
 load_dotenv('config.env')
@@ -35,31 +35,22 @@ BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 WEB_URL = os.getenv('WEB_URL', 'http://localhost:8000')
 API_URL = os.getenv('API_URL', 'http://localhost:8000')
 
+logger = logging.getLogger(__name__)
+
 # ID администраторов
 ADMIN_IDS = [452398375, 8151581578]
 
 # Часовой пояс Казахстана
 KAZAKHSTAN_TZ = pytz.timezone('Asia/Ashkhabad')  # UTC+5
 
-# Инициализация бота
-if not BOT_TOKEN:
-    print("❌ Ошибка: TELEGRAM_BOT_TOKEN не установлен в config.env")
-    print("Создайте файл config.env на основе config.env.example")
-    sys.exit(1)
-
-bot = Bot(
-    token=BOT_TOKEN, 
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-)
+# Диспетчер и обработчики. Bot общий для всего приложения: его создает
+# init_telegram_bot() (app/telegram_notifications.py)
 dp = Dispatcher()
 router = Router()
 
 # Регистрируем роутер сразу
 dp.include_router(router)
 
-# Глобальная переменная для хранения бота (для отправки уведомлений)
-_bot_instance = None
-
 
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь администратором"""
@@ -149,7 +140,7 @@ def get_devices_keyboard() -> InlineKeyboardMarkup:
 async def get_devices_message() -> str:
     """Получить сообщение со списком устройств"""
     try:
-        devices = get_all_devices()
+        devices = await get_all_devices_async()
         
         if not devices:
             return "📱 <b>Устройства</b>\n\n❌ Нет подключенных устройств"
@@ -259,13 +250,13 @@ async def cmd_add_device(message: Message):
     chat_id = message.chat.id
     
     # Проверяем существование устройства
-    device = get_device_by_id(device_id)
+    device = await get_device_by_id_async(device_id)
     if not device:
         await message.answer(f"❌ Устройство с ID <code>{device_id}</code> не найдено.")
         return
     
     # Добавляем привязку
-    success = add_device_binding(device_id, chat_id)
+    success = await add_device_binding_async(device_id, chat_id)
     
     if success:
         await message.answer(
@@ -302,7 +293,7 @@ async def cmd_remove_device(message: Message):
     chat_id = message.chat.id
     
     # Удаляем привязку
-    success = remove_device_binding(device_id, chat_id)
+    success = await remove_device_binding_async(device_id, chat_id)
     
     if success:
         await message.answer(
@@ -325,7 +316,7 @@ async def cmd_list_bindings(message: Message):
         return
     
     chat_id = message.chat.id
-    device_ids = get_chat_bindings(chat_id)
+    device_ids = await get_chat_bindings_async(chat_id)
     
     if not device_ids:
         await message.answer(
@@ -338,7 +329,7 @@ async def cmd_list_bindings(message: Message):
     message_text = f"📋 <b>Привязанные устройства ({len(device_ids)})</b>\n\n"
     
     for i, device_id in enumerate(device_ids, 1):
-        device = get_device_by_id(device_id)
+        device = await get_device_by_id_async(device_id)
         if device:
             message_text += f"{i}. {format_device_info(device)}\n\n"
         else:
@@ -347,67 +338,41 @@ async def cmd_list_bindings(message: Message):
     await message.answer(message_text)
 
 
-async def send_sms_notification(device_id: str, sender: str, message: str, timestamp: str):
-    """Отправить уведомление о новом SMS во все привязанные чаты"""
-    try:
-        # Получаем список чатов для этого устройства
-        chat_ids = get_device_chats(device_id)
-        
-        if not chat_ids:
-            print(f"   ℹ️ Нет привязанных чатов для устройства {device_id}")
-            return
-        
-        # Получаем информацию об устройстве
-        device = get_device_by_id(device_id)
-        device_name = device.get('name', 'Неизвестное устройство') if device else device_id
-        
-        # Форматируем сообщение
-        notification = (
-            f"📨 <b>Новое SMS</b>\n\n"
-            f"<b>Устройство:</b> {device_name}\n"
-            f"<b>От:</b> <code>{sender}</code>\n"
-            f"<b>Время:</b> {timestamp}\n\n"
-            f"<b>Сообщение:</b>\n{message}"
-        )
-        
-        # Отправляем уведомления во все чаты
-        for chat_id in chat_ids:
-            try:
-                await bot.send_message(chat_id, notification)
-                print(f"   ✅ SMS отправлено в чат {chat_id}")
-            except Exception as e:
-                print(f"   ❌ Ошибка отправки в чат {chat_id}: {e}")
-    
-    except Exception as e:
-        print(f"❌ Ошибка отправки SMS уведомлений: {e}")
-
-
 async def main():
     """Главная функция запуска бота (только для standalone режима)"""
-    global _bot_instance
-    _bot_instance = bot
+    setup_logging()
+    
+    if not BOT_TOKEN:
+        logger.critical("TELEGRAM_BOT_TOKEN не установлен в config.env. Создайте файл config.env на основе config.env.example")
+        sys.exit(1)
     
     # Инициализация базы данных
-    init_database()
-    print("✅ База данных инициализирована")
+    await init_database_async()
+    logger.info("База данных инициализирована")
+    
+    init_telegram_bot()
+    bot = get_bot()
+    if bot is None:
+        logger.critical("Не удалось создать Telegram бота, подробности - в записи выше")
+        sys.exit(1)
     
     # Запускаем бота в режиме polling
-    print("🤖 Telegram бот запущен (polling режим)!")
-    print(f"📱 Администраторы: {', '.join(map(str, ADMIN_IDS))}")
-    print(f"🌐 Веб-интерфейс: {WEB_URL}")
-    print("⚠️ Для webhook режима используйте main.py")
+    logger.info(
+        "Telegram бот запущен (polling режим), для webhook режима используйте main.py",
+        extra={'admins': ADMIN_IDS, 'web_url': WEB_URL}
+    )
     
-    await dp.start_polling(bot)
-
-
-def get_bot() -> Bot:
-    """Получить экземпляр бота для внешнего использования"""
-    return _bot_instance
+    try:
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await close_telegram_bot()
 
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n👋 Бот остановлен")
+        logger.info("Бот остановлен")
+    finally:
+        stop_logging()
 
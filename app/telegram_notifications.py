@@ -1,44 +1,144 @@
 """
 Модуль для отправки уведомлений в Telegram
 Работает асинхронно, не блокируя основной поток FastAPI
+
+Здесь создается единственный экземпляр Bot приложения: его используют и
+уведомления (TelegramSender), и webhook бота (app/telegram_bot.py). Bot создается
+при старте приложения (init_telegram_bot) и закрывается при остановке
+(close_telegram_bot). HTTP-сессия держит пул соединений с api.telegram.org
+открытыми (keep-alive), поэтому TLS-рукопожатие выполняется один раз,
+а не при каждом уведомлении.
 """
 import asyncio
+import html
+import logging
 import os
 import re
-from typing import Optional, Tuple
+import ssl
+from typing import Iterable, List, Optional, Tuple
+
+import aiogram
+import certifi
 from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
 from dotenv import load_dotenv
 
-from app.database import get_device_chats, get_device_by_id
+from app.database import get_device_chats_async, get_device_by_id_async
+from app.telegram_sender import TelegramSender
 
 # Загружаем переменные окружения
 load_dotenv('config.env')
 
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
-# Глобальный экземпляр бота
+logger = logging.getLogger(__name__)
+
+# Глобальный экземпляр бота и очередь отправки с учетом лимитов Telegram
 _bot: Optional[Bot] = None
-_loop: Optional[asyncio.AbstractEventLoop] = None
+_sender: Optional[TelegramSender] = None
+_warm_up_task: Optional[asyncio.Task] = None
+
+
+class PooledSession(AiohttpSession):
+    """
+    HTTP-сессия aiogram с настроенным пулом соединений.
+    ClientSession создается здесь (create_session - точка расширения aiogram),
+    поэтому внутренние поля AiohttpSession не используются
+    """
+
+    def __init__(self, pool_size: int, keepalive: float, timeout: float):
+        super().__init__(timeout=timeout)
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self._client: Optional[ClientSession] = None
+
+    async def create_session(self) -> ClientSession:
+        if self._client is None or self._client.closed:
+            connector = TCPConnector(
+                ssl=ssl.create_default_context(cafile=certifi.where()),
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=300
+            )
+            self._client = ClientSession(
+                connector=connector,
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram.__version__}"}
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+            # Даем SSL-соединениям закрыться (как AiohttpSession.close)
+            await asyncio.sleep(0.25)
+        await super().close()
 
 
 def init_telegram_bot():
-    """Инициализировать Telegram бота для отправки уведомлений"""
-    global _bot, _loop
+    """Создать бота приложения (вызывается при старте приложения)"""
+    global _bot, _sender, _warm_up_task
     
     if not BOT_TOKEN:
-        print("⚠️ TELEGRAM_BOT_TOKEN не установлен, уведомления отключены")
+        logger.warning("TELEGRAM_BOT_TOKEN не установлен, уведомления отключены")
         return
     
     try:
+        session = PooledSession(
+            pool_size=int(os.getenv('TELEGRAM_POOL_SIZE', '32')),
+            keepalive=float(os.getenv('TELEGRAM_KEEPALIVE_SECONDS', '60')),
+            timeout=float(os.getenv('TELEGRAM_TIMEOUT_SECONDS', '30'))
+        )
         _bot = Bot(
             token=BOT_TOKEN,
+            session=session,
             default=DefaultBotProperties(parse_mode=ParseMode.HTML)
         )
-        print("✅ Telegram бот для уведомлений инициализирован")
+        _sender = TelegramSender(
+            _bot,
+            global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', '30')),
+            chat_interval=float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1')),
+            retry_limit=int(os.getenv('TELEGRAM_RETRY_LIMIT', '3')),
+            coalesce_window=float(os.getenv('TELEGRAM_COALESCE_MS', '0')) / 1000
+        )
+        # Открываем соединение заранее, чтобы первое уведомление не ждало TLS-рукопожатия
+        _warm_up_task = asyncio.get_running_loop().create_task(_warm_up(_bot), name='telegram-warm-up')
+        logger.info("Telegram бот инициализирован")
+    except Exception as e:
+        logger.error("Ошибка инициализации Telegram бота: %s", e)
+
+
+async def _warm_up(bot: Bot):
+    try:
+        me = await bot.get_me()
+        logger.info("Соединение с Telegram установлено", extra={'bot_username': me.username})
     except Exception as e:
-        print(f"❌ Ошибка инициализации Telegram бота: {e}")
+        logger.warning("Не удалось подключиться к Telegram: %s", e)
+
+
+def get_bot() -> Optional[Bot]:
+    """Бот приложения (None, если TELEGRAM_BOT_TOKEN не задан или бот не создан)"""
+    return _bot
+
+
+async def close_telegram_bot():
+    """Остановить очередь отправки и закрыть HTTP-сессию бота (вызывается при остановке приложения)"""
+    global _bot, _sender, _warm_up_task
+    if _warm_up_task is not None:
+        task, _warm_up_task = _warm_up_task, None
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    if _sender is not None:
+        sender, _sender = _sender, None
+        await sender.close()
+    if _bot is not None:
+        bot, _bot = _bot, None
+        await bot.session.close()
 
 
 def extract_halyk_code(sender: str, message: str) -> Tuple[Optional[str], bool]:
@@ -65,86 +165,97 @@ def extract_halyk_code(sender: str, message: str) -> Tuple[Optional[str], bool]:
     return code, is_apple
 
 
-async def _send_sms_notification_async(device_id: str, sender: str, message: str, timestamp: str):
-    """Асинхронная отправка уведомления о SMS"""
-    if not _bot:
-        return
+def notifications_enabled() -> bool:
+    """Инициализирован ли бот для уведомлений"""
+    return _bot is not None
+
+
+async def format_sms_notification(device_id: str, sender: str, message: str, timestamp: str) -> str:
+    """Текст уведомления о SMS (HTML)"""
+    # Получаем информацию об устройстве
+    device = await get_device_by_id_async(device_id)
+    device_name = device.get('name', 'Неизвестное устройство') if device else device_id
     
-    try:
-        # Получаем список чатов для этого устройства
-        chat_ids = get_device_chats(device_id)
-        
-        if not chat_ids:
-            print(f"   ℹ️ Нет привязанных чатов для устройства {device_id}")
-            return
-        
-        # Получаем информацию об устройстве
-        device = get_device_by_id(device_id)
-        device_name = device.get('name', 'Неизвестное устройство') if device else device_id
-        
-        # Проверяем, есть ли код от Halyk
-        code, is_apple = extract_halyk_code(sender, message)
-        
-        # Форматируем сообщение с кодом в <code> если это Halyk
-        formatted_message = message
-        if code:
-            formatted_message = message.replace(code, f'<code>{code}</code>', 1)
-        
-        # Базовое уведомление
-        notification = (
-            f"📨 <b>Новое SMS</b>\n\n"
-            f"<b>Устройство:</b> {device_name}\n"
-            f"<b>От:</b> <code>{sender}</code>\n"
-            f"<b>Время:</b> {timestamp}\n\n"
-            f"<b>Сообщение:</b>\n{formatted_message}"
-        )
-        
-        # Добавляем предупреждение для Apple Wallet
-        if code and is_apple:
-            notification += "\n\n⚠️ <b>ВНИМАНИЕ!</b> Это код для <b>iPhone</b> (Apple Wallet)!\n🚨 В вашей работе такие коды считаются опасными!"
-        
-        # Отправляем уведомления во все чаты
-        for chat_id in chat_ids:
-            try:
-                # Отправляем основное сообщение
-                await _bot.send_message(chat_id, notification)
-                print(f"   ✅ SMS отправлено в Telegram чат {chat_id}")
-                    
-            except Exception as e:
-                print(f"   ❌ Ошибка отправки в чат {chat_id}: {e}")
+    # Проверяем, есть ли код от Halyk
+    code, is_apple = extract_halyk_code(sender, message)
     
-    except Exception as e:
-        print(f"❌ Ошибка отправки SMS уведомлений: {e}")
+    # Текст SMS и данные устройства экранируются: символы <, > и & в них
+    # иначе ломают HTML-разметку, и Telegram отклоняет сообщение
+    formatted_message = html.escape(message, quote=False)
+    # Форматируем сообщение с кодом в <code> если это Halyk
+    if code:
+        formatted_message = formatted_message.replace(code, f'<code>{code}</code>', 1)
+    
+    # Базовое уведомление
+    notification = (
+        f"📨 <b>Новое SMS</b>\n\n"
+        f"<b>Устройство:</b> {html.escape(str(device_name), quote=False)}\n"
+        f"<b>От:</b> <code>{html.escape(sender, quote=False)}</code>\n"
+        f"<b>Время:</b> {html.escape(timestamp, quote=False)}\n\n"
+        f"<b>Сообщение:</b>\n{formatted_message}"
+    )
+    
+    # Добавляем предупреждение для Apple Wallet
+    if code and is_apple:
+        notification += "\n\n⚠️ <b>ВНИМАНИЕ!</b> Это код для <b>iPhone</b> (Apple Wallet)!\n🚨 В вашей работе такие коды считаются опасными!"
+    
+    return notification
 
 
-def send_sms_notification(device_id: str, sender: str, message: str, timestamp: str):
-    """
-    Отправить уведомление о новом SMS (синхронная обертка)
-    Вызывается из FastAPI
-    """
-    if not _bot:
-        return
-    
-    try:
-        # Создаем новый event loop в отдельном потоке или используем существующий
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(
-            _send_sms_notification_async(device_id, sender, message, timestamp)
-        )
-        loop.close()
-    except Exception as e:
-        print(f"❌ Ошибка в send_sms_notification: {e}")
+class QueuedNotification:
+    """Уведомление о SMS, поставленное в очереди чатов (TelegramSender)"""
+
+    def __init__(self, device_id: str, chat_ids: List[int], futures: List[asyncio.Future]):
+        self.device_id = device_id
+        self.chat_ids = chat_ids
+        self.futures = futures
+
+    async def result(self) -> Tuple[List[int], List[str]]:
+        """
+        Дождаться отправки во все чаты.
+        
+        Returns:
+            Tuple[done_chats, errors]: чаты, которым больше не нужно отправлять
+            (доставлено или чат недоступен для бота), и ошибки, после которых
+            отправку стоит повторить
+        """
+        outcomes = await asyncio.gather(*self.futures, return_exceptions=True)
+        done_chats: List[int] = []
+        errors: List[str] = []
+        for chat_id, outcome in zip(self.chat_ids, outcomes):
+            extra = {'device_id': self.device_id, 'chat_id': chat_id}
+            if not isinstance(outcome, BaseException):
+                done_chats.append(chat_id)
+                logger.info("SMS отправлено в Telegram", extra=extra)
+            elif isinstance(outcome, (TelegramForbiddenError, TelegramBadRequest)):
+                # Бот заблокирован, чат удален и т.п. - повтор не поможет
+                done_chats.append(chat_id)
+                logger.warning("Чат недоступен для уведомлений: %s", outcome, extra=extra)
+            else:
+                errors.append(f"{chat_id}: {outcome}")
+                logger.error("Ошибка отправки в чат: %s", outcome, extra=extra)
+        return done_chats, errors
 
 
-async def send_sms_notification_async(device_id: str, sender: str, message: str, timestamp: str):
+async def queue_sms_notification(device_id: str, sender: str, message: str, timestamp: str,
+                                 skip_chats: Iterable[int] = ()) -> QueuedNotification:
     """
-    Асинхронная версия для использования внутри async контекста
+    Поставить уведомление о SMS в очереди всех привязанных чатов, кроме skip_chats.
+    Уведомления, поставленные раньше, уходят в каждый чат раньше
     """
-    try:
-        await _send_sms_notification_async(device_id, sender, message, timestamp)
-    except Exception as e:
-        print(f"❌ Ошибка в send_sms_notification_async: {e}")
-        import traceback
-        traceback.print_exc()
-
+    if not _sender:
+        raise RuntimeError("Telegram бот для уведомлений не инициализирован")
+    
+    skip = set(skip_chats)
+    chat_ids = [chat_id for chat_id in await get_device_chats_async(device_id) if chat_id not in skip]
+    if not chat_ids:
+        logger.debug("Нет привязанных чатов для устройства", extra={'device_id': device_id})
+        return QueuedNotification(device_id, [], [])
+    
+    notification = await format_sms_notification(device_id, sender, message, timestamp)
+    # Коды Halyk отправляются без ожидания окна склейки
+    code, _ = extract_halyk_code(sender, message)
+    urgent = code is not None
+    return QueuedNotification(
+        device_id, chat_ids, [_sender.send(chat_id, notification, urgent=urgent) for chat_id in chat_ids]
+    )
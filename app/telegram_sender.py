@@ -0,0 +1,240 @@
+"""
+Отправка сообщений в Telegram с учетом ограничений Bot API
+
+Telegram допускает около 30 сообщений в секунду от бота в целом и не больше
+одного сообщения в секунду в один чат; сверх этого отвечает 429 с retry_after.
+TelegramSender отправляет в разные чаты параллельно и соблюдает оба лимита:
+  - общий token bucket на TELEGRAM_GLOBAL_RATE сообщений в секунду;
+  - у каждого чата своя очередь и задача-отправитель: сообщения чата уходят
+    строго по порядку и не чаще раза в TELEGRAM_CHAT_INTERVAL секунд;
+  - на 429 (TelegramRetryAfter) очередь чата ждет retry_after и повторяет то же
+    сообщение (до TELEGRAM_RETRY_LIMIT раз), следующие сообщения чата ждут его.
+
+send() только ставит сообщение в очередь и сразу возвращает Future, поэтому
+рассылка в 50 чатов занимает микросекунды, а не 50 последовательных запросов.
+Задача чата завершается, если сообщений нет дольше IDLE_SECONDS.
+
+Склейка (TELEGRAM_COALESCE_MS, 0 - выключена): сообщения чата, пришедшие в течение
+окна после первого, отправляются одним сообщением. Сообщения склеиваются
+только целиком (HTML-разметка каждого остается закрытой), склейка длиннее
+MESSAGE_LIMIT символов делится на несколько сообщений. Если Telegram отклонил
+склейку (TelegramBadRequest), ее части отправляются по отдельности, чтобы ошибка
+одного сообщения не затронула остальные. Срочные сообщения (urgent, например
+коды Halyk) окно не ждут.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from app.admission import TokenBucket
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+# Разделитель склеенных сообщений
+SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+
+def group_messages(parts: List[str], limit: int = MESSAGE_LIMIT) -> List[List[int]]:
+    """
+    Разбить части на группы для склейки через SEPARATOR не длиннее limit.
+    Возвращает индексы частей по группам; части не разрезаются, поэтому
+    часть длиннее limit остается отдельной группой
+    """
+    groups: List[List[int]] = []
+    length = 0
+    for index, part in enumerate(parts):
+        if groups and length + len(SEPARATOR) + len(part) <= limit:
+            groups[-1].append(index)
+            length += len(SEPARATOR) + len(part)
+        else:
+            groups.append([index])
+            length = len(part)
+    return groups
+
+
+class _ChatQueue:
+    """Очередь сообщений одного чата и задача, которая ее отправляет"""
+
+    __slots__ = ('queue', 'task', 'last_sent')
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        self.last_sent = 0.0
+
+
+class TelegramSender:
+    """Параллельная отправка по чатам с общим и поштучным (на чат) лимитом"""
+
+    # Задача чата завершается после стольких секунд без сообщений
+    IDLE_SECONDS = 60.0
+
+    def __init__(self, bot: Bot, global_rate: float = 30, chat_interval: float = 1.0, retry_limit: int = 3,
+                 coalesce_window: float = 0.0):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.retry_limit = retry_limit
+        self.coalesce_window = coalesce_window
+        self._bucket = TokenBucket(global_rate, time.monotonic())
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._closed = False
+
+    def send(self, chat_id: int, text: str, urgent: bool = False) -> asyncio.Future:
+        """
+        Поставить сообщение в очередь чата. Future завершается после отправки
+        (результат - Message) или с исключением отправки.
+        urgent - отправить без ожидания окна склейки
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self._closed:
+            future.set_exception(RuntimeError("Отправка в Telegram остановлена"))
+            return future
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue()
+        chat.queue.put_nowait((text, future, urgent))
+        if chat.task is None or chat.task.done():
+            chat.task = asyncio.create_task(self._run_chat(chat_id, chat), name=f'telegram-chat-{chat_id}')
+        return future
+
+    async def close(self):
+        """Остановить отправку; сообщения, не отправленные к этому моменту, завершаются ошибкой"""
+        self._closed = True
+        chats = list(self._chats.values())
+        self._chats.clear()
+        for chat in chats:
+            if chat.task is not None:
+                chat.task.cancel()
+        await asyncio.gather(*(chat.task for chat in chats if chat.task is not None), return_exceptions=True)
+        for chat in chats:
+            while not chat.queue.empty():
+                _, future, _ = chat.queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError("Отправка в Telegram остановлена"))
+
+    async def _run_chat(self, chat_id: int, chat: _ChatQueue):
+        while True:
+            try:
+                item = await asyncio.wait_for(chat.queue.get(), self.IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                # Сообщение могло прийти, пока отменялось ожидание: send видел живую
+                # задачу и новую не создал - продолжаем отправку
+                if not chat.queue.empty():
+                    continue
+                if self._chats.get(chat_id) is chat:
+                    del self._chats[chat_id]
+                return
+            text, future, urgent = item
+            if urgent or self.coalesce_window <= 0:
+                await self._deliver(chat_id, chat, [text], [future])
+                continue
+            await self._coalesce(chat_id, chat, item)
+
+    async def _coalesce(self, chat_id: int, chat: _ChatQueue, first):
+        """Собрать сообщения чата за окно склейки и отправить их вместе"""
+        texts, futures = [first[0]], [first[1]]
+        deadline = time.monotonic() + self.coalesce_window
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    text, future, urgent = await asyncio.wait_for(chat.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if urgent:
+                    # Срочное сообщение уходит сразу, собранные ждут окончания окна
+                    await self._deliver(chat_id, chat, [text], [future])
+                else:
+                    texts.append(text)
+                    futures.append(future)
+        except asyncio.CancelledError:
+            self._fail(futures, RuntimeError("Отправка в Telegram остановлена"))
+            raise
+        await self._deliver(chat_id, chat, texts, futures)
+
+    async def _deliver(self, chat_id: int, chat: _ChatQueue, texts: List[str], futures: List[asyncio.Future]):
+        """Отправить тексты (склеенные, если их несколько) и завершить их Future"""
+        pending = [(text, future) for text, future in zip(texts, futures) if not future.done()]
+        if not pending:
+            return
+        groups = group_messages([text for text, _ in pending])
+        try:
+            for group in groups:
+                await self._deliver_group(chat_id, chat, [pending[index] for index in group])
+        except asyncio.CancelledError:
+            self._fail([future for _, future in pending], RuntimeError("Отправка в Telegram остановлена"))
+            raise
+
+    async def _deliver_group(self, chat_id: int, chat: _ChatQueue, items: List):
+        futures = [future for _, future in items]
+        try:
+            result = await self._send_with_retry(chat_id, chat, SEPARATOR.join(text for text, _ in items))
+        except TelegramBadRequest as e:
+            if len(items) == 1:
+                self._fail(futures, e)
+                return
+            # Склейку отклонила одна из частей - отправляем части по отдельности
+            logger.warning("Telegram отклонил склеенное сообщение, части отправляются отдельно: %s", e,
+                           extra={'chat_id': chat_id, 'parts': len(items)})
+            for item in items:
+                await self._deliver_group(chat_id, chat, [item])
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._fail(futures, e)
+            return
+        if len(items) > 1:
+            metrics.increment('telegram_messages_coalesced', len(items) - 1)
+        for future in futures:
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _fail(futures: List[asyncio.Future], error: BaseException):
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _send_with_retry(self, chat_id: int, chat: _ChatQueue, text: str):
+        attempt = 0
+        while True:
+            # Не чаще раза в chat_interval в один чат
+            wait = chat.last_sent + self.chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._acquire_global()
+            try:
+                message = await self.bot.send_message(chat_id, text)
+                chat.last_sent = time.monotonic()
+                metrics.increment('telegram_messages_sent')
+                return message
+            except TelegramRetryAfter as e:
+                chat.last_sent = time.monotonic()
+                attempt += 1
+                metrics.increment('telegram_retry_after')
+                if attempt > self.retry_limit:
+                    raise
+                logger.warning(
+                    "Ограничение Telegram, повтор через %s с", e.retry_after,
+                    extra={'chat_id': chat_id, 'attempt': attempt}
+                )
+                await asyncio.sleep(e.retry_after)
+
+    async def _acquire_global(self):
+        """Дождаться токена общего лимита"""
+        while True:
+            wait = self._bucket.take(self.global_rate, self.global_rate, time.monotonic())
+            if not wait:
+                return
+            await asyncio.sleep(wait)
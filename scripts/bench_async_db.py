@@ -0,0 +1,179 @@
+"""
+Бенчмарк: задержка чтения /devices во время насыщающей записи в /event
+
+Запускает uvicorn с временной базой данных и измеряет p50/p95/p99
+задержки конкурентных запросов GET /devices:
+  1. только чтение
+  2. чтение одновременно с непрерывным потоком POST /event
+
+Если доступ к базе не блокирует event loop, чтение не ждет записи, но задержки
+во второй фазе все же растут из-за конкуренции за процессор (один процесс uvicorn).
+Каждый писатель отправляет свои события (непересекающиеся номера и уникальный
+event_id), поэтому записи не подтверждаются как повторы; считаются только ответы 2xx,
+остальные выводятся отдельно. Лимиты приема (app/admission.py) в бенчмарке отключены.
+
+Запуск из корня проекта:
+    python scripts/bench_async_db.py --readers 20 --writers 50 --duration 10
+
+Масштабирование записи по шардам (app/storage.py) - тот же запуск с переменной окружения:
+    DATABASE_SHARDS=4 python scripts/bench_async_db.py
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+
+def percentile(values, p):
+    """Перцентиль p (0-100) по отсортированному списку"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def make_event(i: int, devices: int) -> dict:
+    """Событие device_status или sms для одного из тестовых устройств (уникальное для каждого i)"""
+    device_id = f"bench{i % devices:04d}"
+    event = {
+        "type": "sms" if i % 5 == 0 else "device_status",
+        "event_id": f"bench-{i}",
+        "timestamp": time.strftime("%d.%m.%Y %H:%M:%S"),
+        "device": {
+            "id": device_id,
+            "name": f"Bench {device_id}",
+            "battery": i % 100,
+            "signalStrength": i % 5,
+            "networkType": "4G (LTE)",
+            "internetConnected": True,
+            "connectionType": "Wi-Fi"
+        }
+    }
+    if event["type"] == "sms":
+        event["from"] = "+77051234567"
+        event["message"] = f"Бенчмарк сообщение {i}"
+    return event
+
+
+async def reader(session, url, stop_at, latencies):
+    while time.perf_counter() < stop_at:
+        started = time.perf_counter()
+        async with session.get(f"{url}/devices") as response:
+            await response.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+
+
+async def writer(session, url, stop_at, counter, devices, start, step):
+    # Номера событий писателя: start, start + step, ... - не пересекаются с другими писателями
+    i = start
+    while time.perf_counter() < stop_at:
+        async with session.post(f"{url}/event", json=make_event(i, devices)) as response:
+            body = await response.read()
+            if 200 <= response.status < 300 and b'"duplicate"' not in body:
+                counter['written'] += 1
+            else:
+                counter[response.status] = counter.get(response.status, 0) + 1
+        i += step
+
+
+async def run_phase(url, readers, writers, duration, devices, offset=0):
+    latencies = []
+    counter = {'written': 0}
+    stop_at = time.perf_counter() + duration
+    connector = aiohttp.TCPConnector(limit=readers + writers)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [reader(session, url, stop_at, latencies) for _ in range(readers)]
+        tasks += [writer(session, url, stop_at, counter, devices, offset + w, writers) for w in range(writers)]
+        await asyncio.gather(*tasks)
+    return latencies, counter
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            try:
+                async with session.get(f"{url}/devices") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Сервер не запустился")
+
+
+async def seed(url, devices):
+    async with aiohttp.ClientSession() as session:
+        for i in range(devices):
+            async with session.post(f"{url}/event", json=make_event(i * 5 + 1, devices)) as response:
+                await response.read()
+
+
+def report(title, latencies, duration, counter=None):
+    print(f"\n{title}")
+    print(f"  запросов /devices: {len(latencies)} ({len(latencies) / duration:.0f}/с)")
+    if counter is not None:
+        written = counter['written']
+        print(f"  событий /event:    {written} ({written / duration:.0f}/с)")
+        failed = {status: count for status, count in counter.items() if status != 'written'}
+        if failed:
+            print(f"  не записано (повторы и ошибки по статусу): {failed}")
+    print(f"  p50={percentile(latencies, 50):.1f} мс  p95={percentile(latencies, 95):.1f} мс  "
+          f"p99={percentile(latencies, 99):.1f} мс  max={max(latencies, default=0):.1f} мс  "
+          f"mean={statistics.fmean(latencies) if latencies else 0:.1f} мс")
+
+
+async def main_async(args, url):
+    await wait_ready(url)
+    await seed(url, args.devices)
+
+    latencies, _ = await run_phase(url, args.readers, 0, args.duration, args.devices)
+    report("Только чтение", latencies, args.duration)
+
+    # Номера событий фазы записи не пересекаются с событиями seed
+    latencies, counter = await run_phase(url, args.readers, args.writers, args.duration, args.devices,
+                                         offset=args.devices * 5 + 1)
+    report("Чтение во время записи", latencies, args.duration, counter)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=20, help="конкурентных читателей /devices")
+    parser.add_argument("--writers", type=int, default=50, help="конкурентных писателей /event")
+    parser.add_argument("--devices", type=int, default=200, help="количество тестовых устройств")
+    parser.add_argument("--duration", type=float, default=10.0, help="длительность фазы, с")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    env = dict(
+        os.environ,
+        DATABASE_PATH=os.path.join(workdir, "devices.db"),
+        TELEGRAM_BOT_TOKEN=os.getenv("TELEGRAM_BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARK"),
+        WEB_URL="http://localhost:8000",
+        PYTHONPATH=project_root,
+        # Бенчмарк измеряет запись, а не ответы 429
+        ADMISSION_DEVICE_RATE="0",
+        ADMISSION_MAX_IN_FLIGHT="0",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL
+    )
+    try:
+        asyncio.run(main_async(args, f"http://127.0.0.1:{args.port}"))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Бенчмарк разбора событий POST /event: словарь против типизированных моделей
+
+Сравнивает затраты CPU на одно событие без сети и базы данных:
+  dict  - тело как Dict[str, Any] (разбор FastAPI), обход словаря через .get()
+          и сериализация события для журнала (как receive_event до app/models.py)
+  typed - сырое тело, parse_event (app/models.py), данные для update_device_tx
+          и сериализация модели для журнала
+Первая таблица - только разбор и сериализация, вторая - вызов маршрута FastAPI
+напрямую через ASGI (с разбором тела запроса самим фреймворком).
+Отдельно измеряется отказ для события с ошибкой формата.
+
+Запуск из корня проекта:
+    python scripts/bench_event_parsing.py --number 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import timeit
+from typing import Any, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI, Request
+
+from app.event_codec import encode_event
+from app.models import parse_event
+
+
+EVENTS = {
+    "device_status": {
+        "type": "device_status",
+        "timestamp": "15.10.2025 14:30:00",
+        "device": {
+            "name": "OnePlus GM1920",
+            "id": "abd7b5e86a733e8c",
+            "battery": 85,
+            "hasSignal": True,
+            "signalStrength": 4,
+            "networkType": "4G (LTE) (Tele2)",
+            "internetConnected": True,
+            "connectionType": "Wi-Fi"
+        }
+    },
+    "sms": {
+        "type": "sms",
+        "timestamp": "15.10.2025 14:32:00",
+        "from": "Halyk",
+        "message": "Ваш код подтверждения: 123456",
+        "device": {
+            "name": "OnePlus GM1920",
+            "id": "abd7b5e86a733e8c",
+            "battery": 45,
+            "hasSignal": True,
+            "signalStrength": 4,
+            "networkType": "4G (LTE) (Tele2)",
+            "internetConnected": True
+        }
+    },
+    "boot_completed": {
+        "type": "boot_completed",
+        "timestamp": "15.10.2025 09:00:00",
+        "device": {"name": "OnePlus GM1920", "id": "abd7b5e86a733e8c", "battery": 78},
+        "network": {"hasSignal": True, "signalStrength": 3, "networkType": "4G (LTE) (Tele2)", "canReceiveSms": True},
+        "internet": {"connected": True, "type": "Wi-Fi"}
+    },
+}
+
+MALFORMED = json.dumps({"type": "sms", "device": {"id": "x", "battery": "full"}}).encode()
+
+
+def dict_handler(event: dict):
+    """Обработка как в receive_event до перехода на модели"""
+    event_type = event.get('type')
+    timestamp = event.get('timestamp')
+    if not event_type or not timestamp:
+        raise ValueError("Отсутствуют обязательные поля")
+    device_data = event.get('device', {})
+    device_id = device_data.get('id') or event.get('device_id')
+    battery = device_data.get('battery', 0)
+    signal_strength_raw = device_data.get('signalStrength', 0)
+    signal_strength = int((signal_strength_raw / 4) * 100) if signal_strength_raw else 0
+    network_type = device_data.get('networkType', 'Unknown')
+    internet_connected = device_data.get('internetConnected', False)
+    connection_type = device_data.get('connectionType', 'Unknown')
+    internet_type = f"{connection_type}" if internet_connected else 'Disconnected'
+    update_data = {
+        'battery': battery,
+        'signal_strength': signal_strength,
+        'network_type': network_type,
+        'internet': internet_type,
+        'timestamp': timestamp
+    }
+    notification = None
+    if event_type == "sms":
+        notification = (event.get('from', 'Unknown'), event.get('message', ''))
+    return device_id, encode_event(event), update_data, notification
+
+
+def dict_path(body: bytes):
+    return dict_handler(json.loads(body))
+
+
+def typed_path(body: bytes):
+    """Разбор через единый валидатор app/models.py"""
+    event = parse_event(body)
+    device_id = event.device.id or event.device_id
+    update_data = event.device.status_update(event.timestamp)
+    notification = (event.sender, event.message) if event.type == "sms" else None
+    return device_id, encode_event(event.payload()), update_data, notification
+
+
+app = FastAPI()
+
+
+@app.post("/dict")
+async def dict_route(event: Dict[str, Any]):
+    dict_handler(event)
+    return {"status": "success"}
+
+
+@app.post("/typed")
+async def typed_route(request: Request):
+    typed_path(await request.body())
+    return {"status": "success"}
+
+
+async def measure_route(path: str, body: bytes, number: int) -> float:
+    """Среднее время вызова маршрута через ASGI без сети, мкс"""
+    scope = {
+        'type': 'http', 'method': 'POST', 'path': path, 'root_path': '', 'query_string': b'',
+        'headers': [(b'content-type', b'application/json')], 'http_version': '1.1',
+        'scheme': 'http', 'server': ('bench', 80), 'client': ('bench', 1)
+    }
+    message = {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def receive():
+        return message
+
+    async def send(_):
+        pass
+
+    best = float('inf')
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(number):
+            await app(scope, receive, send)
+        best = min(best, time.perf_counter() - started)
+    return best / number * 1_000_000
+
+
+def measure(func, body: bytes, number: int) -> float:
+    """Среднее время одного вызова, мкс"""
+    timer = timeit.Timer(lambda: func(body))
+    best = min(timer.repeat(repeat=5, number=number))
+    return best / number * 1_000_000
+
+
+def measure_rejection(func, body: bytes, number: int) -> float:
+    def call():
+        try:
+            func(body)
+        except Exception:
+            pass
+    best = min(timeit.Timer(call).repeat(repeat=5, number=number))
+    return best / number * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="вызовов в одном замере")
+    args = parser.parse_args()
+
+    bodies = {name: json.dumps(event, ensure_ascii=False).encode() for name, event in EVENTS.items()}
+
+    print("Разбор и сериализация события")
+    print(f"{'событие':<16}{'dict, мкс':>12}{'typed, мкс':>12}{'ускорение':>12}")
+    for name, body in bodies.items():
+        dict_us = measure(dict_path, body, args.number)
+        typed_us = measure(typed_path, body, args.number)
+        print(f"{name:<16}{dict_us:>12.2f}{typed_us:>12.2f}{dict_us / typed_us:>11.2f}x")
+
+    print("\nМаршрут FastAPI (ASGI)")
+    print(f"{'событие':<16}{'dict, мкс':>12}{'typed, мкс':>12}{'ускорение':>12}")
+    route_number = max(1, args.number // 10)
+    for name, body in bodies.items():
+        dict_us = asyncio.run(measure_route("/dict", body, route_number))
+        typed_us = asyncio.run(measure_route("/typed", body, route_number))
+        print(f"{name:<16}{dict_us:>12.2f}{typed_us:>12.2f}{dict_us / typed_us:>11.2f}x")
+
+    # Словарный путь пропускает такое событие до записи в базу (battery="full")
+    typed_us = measure_rejection(typed_path, MALFORMED, args.number)
+    print(f"\nОтказ для события с ошибкой формата (typed): {typed_us:.2f} мкс")
+
+
+if __name__ == "__main__":
+    main()
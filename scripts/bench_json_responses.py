@@ -0,0 +1,86 @@
+"""
+Бенчмарк JSON-ответов: время ответа в зависимости от размера данных
+
+Для страницы истории SMS из N строк сравнивается:
+  json   - строки sqlite3.Row, копия dict(row), JSONResponse (стандартный json)
+  orjson - строки-словари (фабрика _dict_row из app/database.py), ORJSONResponse
+Измеряется выборка из SQLite (в памяти) и сериализация ответа.
+
+Запуск из корня проекта:
+    python scripts/bench_json_responses.py --sizes 10 50 500 5000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from app.database import _fetch_dicts
+
+
+QUERY = "SELECT * FROM sms_logs WHERE device_id = ? ORDER BY id DESC LIMIT ?"
+
+
+def make_database(rows: int) -> sqlite3.Connection:
+    """SQLite в памяти с rows SMS одного устройства"""
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""
+        CREATE TABLE sms_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            sender TEXT,
+            message TEXT,
+            timestamp_ts INTEGER
+        )
+    """)
+    conn.executemany(
+        "INSERT INTO sms_logs (device_id, timestamp, sender, message, timestamp_ts) VALUES (?, ?, ?, ?, ?)",
+        [
+            ('abd7b5e86a733e8c', '15.10.2025 14:32:00', 'Halyk',
+             f'Ваш код подтверждения: {i:06d}. Никому не сообщайте код', 1760521920 + i)
+            for i in range(rows)
+        ]
+    )
+    return conn
+
+
+def json_response(conn: sqlite3.Connection, rows: int) -> bytes:
+    conn.row_factory = sqlite3.Row
+    sms_list = [dict(row) for row in conn.execute(QUERY, ('abd7b5e86a733e8c', rows)).fetchall()]
+    return JSONResponse({"status": "success", "count": len(sms_list), "sms": sms_list}).body
+
+
+def orjson_response(conn: sqlite3.Connection, rows: int) -> bytes:
+    sms_list = _fetch_dicts(conn, QUERY, ('abd7b5e86a733e8c', rows))
+    return ORJSONResponse({"status": "success", "count": len(sms_list), "sms": sms_list}).body
+
+
+def measure(func, conn, rows: int) -> float:
+    """Лучшее среднее время одного ответа, мс"""
+    number = max(3, 20000 // rows)
+    best = min(timeit.Timer(lambda: func(conn, rows)).repeat(repeat=5, number=number))
+    return best / number * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 500, 5000], help="строк в ответе")
+    args = parser.parse_args()
+
+    print(f"{'строк':>8}{'размер, КБ':>12}{'json, мс':>12}{'orjson, мс':>12}{'ускорение':>12}")
+    for rows in args.sizes:
+        conn = make_database(rows)
+        size_kb = len(orjson_response(conn, rows)) / 1024
+        json_ms = measure(json_response, conn, rows)
+        orjson_ms = measure(orjson_response, conn, rows)
+        print(f"{rows:>8}{size_kb:>12.1f}{json_ms:>12.3f}{orjson_ms:>12.3f}{json_ms / orjson_ms:>11.2f}x")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Бенчмарк журналирования на пути приема события
+
+Время в потоке, который принимает событие (вывод направляется в /dev/null,
+чтобы измерять работу журнала, а не терминала):
+  print  - прежний вывод: три print на SMS (с текстом), два на device_status
+  logger - одна запись logging через очередь (app/logging_setup.py),
+           JSON форматируется и выводится в отдельном потоке;
+           для device_status - с выборкой по устройству
+Поток вывода работает во время замера и конкурирует за GIL, поэтому его
+затраты частично входят в результат logger.
+
+Запуск из корня проекта:
+    python scripts/bench_logging.py --number 50000
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.logging_setup import (
+    setup_logging,
+    stop_logging,
+    device_status_sampler,
+    SMS_TEXT_FIELD
+)
+
+SENDER = 'Halyk'
+MESSAGE = 'Ваш код подтверждения: 123456. Никому не сообщайте код'
+DEVICE_ID = 'abd7b5e86a733e8c'
+
+logger = logging.getLogger('app.bench')
+
+
+def print_sms():
+    print(f"\n📥 Получено событие: sms")
+    print(f"   📨 SMS данные: from={SENDER}, message_length={len(MESSAGE)}")
+    print(f"   📨 SMS от {SENDER}: {MESSAGE[:50]}...")
+
+
+def print_device_status():
+    print(f"\n📥 Получено событие: device_status")
+    print(f"   Device ID: {DEVICE_ID}, Type: device_status")
+
+
+def logger_sms():
+    logger.info(
+        "Получено событие",
+        extra={'event_type': 'sms', 'device_id': DEVICE_ID, 'sender': SENDER, SMS_TEXT_FIELD: MESSAGE}
+    )
+
+
+def logger_device_status():
+    skipped = device_status_sampler.sample(DEVICE_ID)
+    if skipped is not None:
+        logger.info(
+            "Получено событие",
+            extra={'event_type': 'device_status', 'device_id': DEVICE_ID, 'skipped': skipped}
+        )
+
+
+def measure(func, number: int) -> float:
+    """Среднее время одного вызова в вызывающем потоке, мкс"""
+    best = min(timeit.Timer(func).repeat(repeat=5, number=number))
+    return best / number * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=50000, help="вызовов в одном замере")
+    args = parser.parse_args()
+
+    # Очередь должна вмещать замер целиком, иначе записи отбрасываются
+    os.environ.setdefault('LOG_QUEUE_SIZE', str(args.number * 10))
+    cases = {
+        'sms': (print_sms, logger_sms),
+        'device_status': (print_device_status, logger_device_status),
+    }
+    results = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        setup_logging()
+        for name, (print_func, logger_func) in cases.items():
+            results[name] = (measure(print_func, args.number), measure(logger_func, args.number))
+        stop_logging()
+
+    print(f"{'событие':<16}{'print, мкс':>12}{'logger, мкс':>13}")
+    for name, (print_us, logger_us) in results.items():
+        print(f"{name:<16}{print_us:>12.2f}{logger_us:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Бенчмарк рассылки уведомления в N чатов
+
+Сравнивается отправка одного уведомления во все привязанные чаты:
+  sequential - прежний цикл: await send_message для каждого чата по очереди
+  sender     - TelegramSender (app/telegram_sender.py): постановка в очереди чатов
+               и параллельная отправка с общим лимитом сообщений в секунду
+Вместо Telegram используется заглушка с задержкой ответа --latency мс.
+Для sender отдельно показано время постановки в очереди.
+
+Запуск из корня проекта:
+    python scripts/bench_telegram_fanout.py --chats 10 30 50 --latency 80
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.telegram_sender import TelegramSender
+
+
+class FakeBot:
+    """Заглушка Bot.send_message с фиксированной задержкой"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def send_message(self, chat_id: int, text: str):
+        await asyncio.sleep(self.latency)
+        return chat_id
+
+
+async def sequential(bot: FakeBot, chats: int) -> float:
+    started = time.perf_counter()
+    for chat_id in range(chats):
+        await bot.send_message(chat_id, "SMS")
+    return time.perf_counter() - started
+
+
+async def with_sender(bot: FakeBot, chats: int, global_rate: float):
+    sender = TelegramSender(bot, global_rate=global_rate)
+    started = time.perf_counter()
+    futures = [sender.send(chat_id, "SMS") for chat_id in range(chats)]
+    queued = time.perf_counter() - started
+    await asyncio.gather(*futures)
+    total = time.perf_counter() - started
+    await sender.close()
+    return queued, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, nargs="+", default=[10, 30, 50], help="чатов в рассылке")
+    parser.add_argument("--latency", type=float, default=80, help="задержка ответа Telegram, мс")
+    parser.add_argument("--global-rate", type=float, default=30, help="общий лимит, сообщений в секунду")
+    args = parser.parse_args()
+
+    bot = FakeBot(args.latency / 1000)
+    print(f"{'чатов':>6}{'sequential, мс':>16}{'в очереди, мс':>16}{'sender, мс':>13}")
+    for chats in args.chats:
+        sequential_s = asyncio.run(sequential(bot, chats))
+        queued_s, sender_s = asyncio.run(with_sender(bot, chats, args.global_rate))
+        print(f"{chats:>6}{sequential_s * 1000:>16.1f}{queued_s * 1000:>16.3f}{sender_s * 1000:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Скрипт для сжатия старых записей журнала событий
+
+События, сохраненные до перехода на сжатый формат (app/event_codec.py),
+хранятся как JSON-текст. Скрипт перекодирует их порциями и возвращает
+освободившееся место файловой системе (инкрементальный VACUUM).
+
+Можно запускать на работающем сервере: каждая порция - короткая транзакция.
+
+Файлы, созданные до включения инкрементального VACUUM, переводятся в режим
+auto_vacuum = INCREMENTAL только полным VACUUM. Он блокирует запись в файл
+на все время работы, поэтому выполняется только с --vacuum и при остановленном сервере.
+
+Запуск из корня проекта:
+    python scripts/compact_events.py
+    python scripts/compact_events.py --vacuum
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения до импорта модуля базы данных (DATABASE_PATH)
+load_dotenv('config.env')
+
+from app.database import (
+    layout,
+    connection,
+    init_database,
+    compact_legacy_events_tx,
+    incremental_vacuum_tx,
+    get_storage_stats
+)
+
+CHUNK_SIZE = 1000
+CHUNK_PAUSE = 0.05
+
+
+def enable_incremental_vacuum():
+    """Перевести файлы базы в режим auto_vacuum = INCREMENTAL полным VACUUM"""
+    for database in layout.files:
+        with connection(database) as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                continue
+            print(f"🧹 VACUUM {database}...")
+            started = time.perf_counter()
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            print(f"   готово за {time.perf_counter() - started:.1f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vacuum", action="store_true",
+                        help="полный VACUUM файлов без инкрементального режима (сервер должен быть остановлен)")
+    args = parser.parse_args()
+
+    init_database()
+    before = get_storage_stats()
+    print(f"📦 Размер базы: {before['size_bytes'] / 1024 / 1024:.1f} МБ")
+
+    total = 0
+    for database in layout.files:
+        while True:
+            with connection(database) as conn:
+                compacted = compact_legacy_events_tx(conn, CHUNK_SIZE)
+            total += compacted
+            if compacted:
+                print(f"   Перекодировано событий: {total}", end="\r")
+            if compacted < CHUNK_SIZE:
+                break
+            time.sleep(CHUNK_PAUSE)
+    print(f"\n✅ Перекодировано событий: {total}")
+
+    if args.vacuum:
+        enable_incremental_vacuum()
+
+    reclaimed = 0
+    for database in layout.files:
+        while True:
+            with connection(database) as conn:
+                step = incremental_vacuum_tx(conn, 1024)
+            reclaimed += step
+            if step <= 0:
+                break
+
+    after = get_storage_stats()
+    print(f"✅ Освобождено: {reclaimed / 1024 / 1024:.1f} МБ")
+    print(f"📦 Размер базы: {after['size_bytes'] / 1024 / 1024:.1f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Скрипт для переноса событий и SMS по шардам (app/storage.py)
+
+Нужен после изменения DATABASE_SHARDS: журналы events и sms_logs устройства
+переносятся в файл-шард, который для него выбирает текущая конфигурация.
+Источники - каталог и все найденные рядом файлы шардов (в том числе от
+прежнего, большего числа шардов).
+
+Запускать при остановленном сервере. Перенос идет порциями: каждая порция
+копируется и удаляется из источника в одной транзакции (через ATTACH).
+SMS и события получают в шарде новые id, поэтому перед переносом очередь
+уведомлений (notification_outbox) должна быть пуста - скрипт это проверяет.
+
+Запуск из корня проекта:
+    DATABASE_SHARDS=4 python scripts/reshard_storage.py
+"""
+import glob
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения до импорта модуля базы данных (DATABASE_PATH, DATABASE_SHARDS)
+load_dotenv('config.env')
+
+from app.database import layout, get_connection, init_database
+
+CHUNK_SIZE = 1000
+
+# Колонки, которые переносятся (id назначает шард-получатель)
+TABLE_COLUMNS = {
+    'events': 'device_id, type, timestamp, timestamp_ts, data, dedup_key',
+    'sms_logs': 'device_id, timestamp, timestamp_ts, sender, message',
+}
+
+
+def source_files():
+    """Каталог, шарды текущей конфигурации и оставшиеся файлы прежних шардов"""
+    root, ext = os.path.splitext(layout.catalog)
+    found = sorted(glob.glob(f"{glob.escape(root)}.shard*{ext or '.db'}"))
+    return list(dict.fromkeys(layout.files + found))
+
+
+def move_device(conn, table: str, device_id: str) -> int:
+    """Перенести строки устройства из main в шард target порциями. Возвращает число строк"""
+    columns = TABLE_COLUMNS[table]
+    moved = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        ids = [row[0] for row in conn.execute(
+            f"SELECT id FROM main.{table} WHERE device_id = ? ORDER BY id LIMIT ?",
+            (device_id, CHUNK_SIZE)
+        )]
+        if not ids:
+            conn.execute("ROLLBACK")
+            return moved
+        placeholders = ','.join('?' * len(ids))
+        conn.execute(
+            f"INSERT INTO target.{table} ({columns}) "
+            f"SELECT {columns} FROM main.{table} WHERE id IN ({placeholders}) ORDER BY id",
+            ids
+        )
+        conn.execute(f"DELETE FROM main.{table} WHERE id IN ({placeholders})", ids)
+        conn.execute("COMMIT")
+        moved += len(ids)
+
+
+def pending_notifications(sources) -> int:
+    """Неотправленные уведомления о SMS во всех источниках"""
+    total = 0
+    for source in sources:
+        conn = get_connection(source)
+        try:
+            total += conn.execute(
+                "SELECT COUNT(*) FROM notification_outbox WHERE status = 'pending'"
+            ).fetchone()[0]
+        finally:
+            conn.close()
+    return total
+
+
+def main():
+    # Создаем файлы шардов текущей конфигурации и применяем миграции
+    init_database()
+    print(f"📦 Шардов: {layout.shard_count}")
+
+    pending = pending_notifications(source_files())
+    if pending:
+        print(f"❌ В очереди {pending} неотправленных уведомлений о SMS.")
+        print("   Запустите сервер, дождитесь их отправки (GET /metrics, outbox.pending = 0) и повторите перенос")
+        sys.exit(1)
+
+    total = 0
+    for source in source_files():
+        conn = get_connection(source)
+        conn.isolation_level = None
+        try:
+            for table in TABLE_COLUMNS:
+                device_ids = [row[0] for row in conn.execute(f"SELECT DISTINCT device_id FROM {table}")]
+                for device_id in device_ids:
+                    target = layout.shard_for(device_id)
+                    if os.path.abspath(target) == os.path.abspath(source):
+                        continue
+                    conn.execute("ATTACH DATABASE ? AS target", (target,))
+                    try:
+                        moved = move_device(conn, table, device_id)
+                    finally:
+                        conn.execute("DETACH DATABASE target")
+                    total += moved
+                    print(f"   {table}: {device_id} {source} -> {target}: {moved}")
+        finally:
+            conn.close()
+
+    print(f"✅ Перенесено строк: {total}")
+    print("ℹ️ Освободить место в источниках можно скриптом scripts/compact_events.py,")
+    print("   файлы шардов, которых нет в текущей конфигурации, после переноса пусты и их можно удалить")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Проверки TelegramSender (app/telegram_sender.py)
+
+Запуск из корня проекта:
+    python -m pytest -q tests
+"""
+import asyncio
+import unittest
+
+from app.telegram_sender import TelegramSender, _ChatQueue
+
+
+class FakeBot:
+    """Заглушка Bot.send_message: запоминает отправленные тексты"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id: int, text: str):
+        self.sent.append((chat_id, text))
+        return text
+
+
+class LateQueue(asyncio.Queue):
+    """
+    Очередь, в которой таймаут ожидания задачи чата совпадает с новым сообщением:
+    on_idle ставит сообщение (send видит еще живую задачу), затем ожидание истекает
+    """
+
+    def __init__(self, on_idle):
+        super().__init__()
+        self.on_idle = on_idle
+
+    async def get(self):
+        if self.empty() and self.on_idle is not None:
+            on_idle, self.on_idle = self.on_idle, None
+            on_idle()
+            raise asyncio.TimeoutError
+        return await super().get()
+
+
+class IdleTimeoutTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_message_queued_during_idle_timeout_is_sent(self):
+        bot = FakeBot()
+        sender = TelegramSender(bot, global_rate=1000, chat_interval=0)
+        late = []
+        chat = sender._chats[1] = _ChatQueue()
+        chat.queue = LateQueue(lambda: late.append(sender.send(1, "late")))
+        try:
+            self.assertEqual(await asyncio.wait_for(sender.send(1, "first"), 1), "first")
+            self.assertEqual(await asyncio.wait_for(late[0], 1), "late")
+            self.assertEqual(bot.sent, [(1, "first"), (1, "late")])
+        finally:
+            await sender.close()
+
+    async def test_idle_chat_is_released(self):
+        sender = TelegramSender(FakeBot(), global_rate=1000, chat_interval=0)
+        sender.IDLE_SECONDS = 0.01
+        try:
+            await asyncio.wait_for(sender.send(1, "text"), 1)
+            await asyncio.sleep(0.05)
+            self.assertNotIn(1, sender._chats)
+        finally:
+            await sender.close()
+
+
+if __name__ == "__main__":
+    unittest.main()